@@ -0,0 +1,85 @@
+import json
+import os
+import sys
+import pygame
+
+class Assets():
+    # images are loaded once, converted to the pixel format of the display and shared by all
+    # painters, from a packed atlas (one file to decode) if there is an up to date one
+    path = 'imgs'
+    atlas = 'atlas.png'
+    index = 'atlas.json'
+    # width of the atlas rows
+    width = 1024
+    _images = None
+
+    @classmethod
+    def image(cls, name):
+        # surface of imgs/<name>.png, None if there is no such image, the display has to be open
+        if cls._images is None:
+            cls._images = cls.load_atlas() or cls.load_files()
+        return cls._images.get(name)
+
+    @classmethod
+    def sources(cls):
+        return sorted(f for f in os.listdir(cls.path) if f.endswith('.png') and f != cls.atlas)
+
+    @staticmethod
+    def convert(image):
+        if image.get_flags() & pygame.SRCALPHA:
+            return image.convert_alpha()
+        return image.convert()
+
+    @classmethod
+    def load_files(cls):
+        images = {}
+        for f in cls.sources():
+            try:
+                images[f[:-4]] = cls.convert(pygame.image.load(os.path.join(cls.path, f)))
+            except pygame.error as e:
+                print('image %s: %s' % (f, e), file=sys.stderr)
+        return images
+
+    @classmethod
+    def load_atlas(cls):
+        # None if there is no atlas or an image changed since it was written
+        try:
+            with open(os.path.join(cls.path, cls.index)) as f:
+                index = json.load(f)
+            sources = cls.sources()
+            if sorted(name + '.png' for name in index['images']) != sources:
+                return None
+            if max(os.path.getmtime(os.path.join(cls.path, f)) for f in sources) > index['mtime']:
+                return None
+            atlas = cls.convert(pygame.image.load(os.path.join(cls.path, cls.atlas)))
+        except (OSError, ValueError, KeyError, pygame.error):
+            return None
+        # the images share the pixels of the atlas
+        return {name: atlas.subsurface(rect) for name, rect in index['images'].items()}
+
+    @classmethod
+    def write_atlas(cls):
+        # packs the images in rows of at most width pixels, the highest ones first
+        sources = cls.sources()
+        images = {f[:-4]: pygame.image.load(os.path.join(cls.path, f)) for f in sources}
+        rects = {}
+        x = y = row = 0
+        for name in sorted(images, key=lambda name: -images[name].get_height()):
+            w, h = images[name].get_size()
+            if x and x + w > cls.width:
+                x = 0
+                y += row
+                row = 0
+            rects[name] = (x, y, w, h)
+            x += w
+            row = max(row, h)
+        size = (max([r[0] + r[2] for r in rects.values()] or [1]), y + row or 1)
+        atlas = pygame.Surface(size, pygame.SRCALPHA, 32)
+        for name, image in images.items():
+            # copy the pixels as they are instead of blending them over the empty atlas
+            atlas.blit(image.convert_alpha(), rects[name][:2], special_flags=pygame.BLEND_RGBA_ADD)
+        mtime = max([os.path.getmtime(os.path.join(cls.path, f)) for f in sources] or [0])
+        pygame.image.save(atlas, os.path.join(cls.path, cls.atlas))
+        with open(os.path.join(cls.path, cls.index), 'w') as f:
+            json.dump({'mtime': mtime, 'images': rects}, f)
+        cls._images = None
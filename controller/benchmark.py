@@ -0,0 +1,183 @@
+import os
+# run without display and sound hardware
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import argparse
+import json
+from contextlib import redirect_stdout
+import pty
+import resource
+import sys
+import tty
+from _thread import start_new_thread
+from queue import Queue, Empty
+from time import perf_counter
+from serial import Serial
+from config import Config
+from device_config import DEVICE_CONFIG
+from devices import Devices
+from session import Session
+
+class FakeBoard():
+    # answers the serial protocol of the lightbar/buzzer firmware on a pty
+    def __init__(self, id, echo):
+        self.id = id
+        self.echo = echo
+        self.lines = 0
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        start_new_thread(self.loop, (()))
+
+    def loop(self):
+        buf = b''
+        binary = False
+        echo = self.echo
+        while True:
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError:
+                return
+            while buf:
+                if binary and buf[0] & 0x80:
+                    # binary frame
+                    if len(buf) < 5:
+                        break
+                    buf = buf[5:]
+                    self.lines += 1
+                    continue
+                if b'\n' not in buf:
+                    break
+                binary = False
+                line, buf = buf.split(b'\n', 1)
+                line = line.strip()
+                self.lines += 1
+                reply = b''
+                if echo:
+                    reply += line + b'\r\n'
+                if line == b'i':
+                    reply += self.id + b' bin noecho\r\n'
+                elif line == b'b 1':
+                    binary = True
+                    reply += b'ok\r\n'
+                elif line == b'e 0':
+                    echo = False
+                    reply += b'ok\r\n'
+                if reply:
+                    os.write(self.master, reply)
+
+def attach(board_name, count=1):
+    # count lightbars and buzzers, every step is mirrored to all of them
+    dev = DEVICE_CONFIG[board_name]
+    def open_board(id):
+        ser = Serial(FakeBoard(id, dev['echo']).port, baudrate=dev['baud'], timeout=0.1)
+        return Devices.open(Devices.negotiate(dev, ser, [b'bin', b'noecho']), ser)
+    Devices._lightbars = [open_board(b'EMDR Lightbar') for _ in range(count)]
+    Devices._buzzers = [open_board(b'EMDR Buzzer') for _ in range(count)]
+
+def rusage():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime, r.ru_nvcsw + r.ru_nivcsw
+
+def run_speed(session, events, speed, seconds):
+    session.set_speed(speed)
+    # make sure to see at least a few full sweeps
+    seconds = max(seconds, 2.5 * 60 / speed)
+    crossings = []
+    crossed = lambda what, value: crossings.append(perf_counter()) if what == 'counter' and value else None
+    session.observers.append(crossed)
+    cpu_start, csw_start = rusage()
+    session.start()
+    Devices.reset_stats()
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        try:
+            kind, attrs = events.get(timeout=0.1)
+        except Empty:
+            continue
+        if kind == 'action':
+            session.action(**attrs)
+    session.observers.remove(crossed)
+    elapsed = perf_counter() - start
+    cpu_end, csw_end = rusage()
+    report = session.recorder.report().get(speed, {})
+    missed = session.scheduler.missed
+    devices = Devices.stats()
+    session.end()
+    session.reset()
+    while not events.empty():
+        events.get()
+    achieved = 0
+    if len(crossings) > 1:
+        achieved = (len(crossings) - 1) / (crossings[-1] - crossings[0]) * 60
+    return {
+        'speed': speed,
+        'seconds': elapsed,
+        'target_per_min': speed,
+        'achieved_per_min': achieved,
+        'ratio': achieved / speed,
+        'ticks': report.get('ticks', 0),
+        'missed': missed,
+        'overruns': report.get('overruns', 0),
+        'dropped': report.get('dropped', 0),
+        'devices': devices,
+        'jitter_ms': {stage: report[stage] for stage in ('timer', 'queue', 'write') if stage in report},
+        'cpu_seconds': cpu_end - cpu_start,
+        'cpu_percent': (cpu_end - cpu_start) / elapsed * 100,
+        'context_switches': csw_end - csw_start,
+    }
+
+def main_benchmark(argv):
+    parser = argparse.ArgumentParser(description='benchmark the EMDR session engine timing path')
+    parser.add_argument('--speeds', default=','.join(str(s) for s in Config.speeds),
+                        help='comma separated list of speeds, default: all of Config.speeds')
+    parser.add_argument('--seconds', type=float, default=5, help='minimum run time per speed')
+    parser.add_argument('--board', default='Raspberry Pi Pico', choices=list(DEVICE_CONFIG.keys()),
+                        help='board type to emulate (decides about echo handling)')
+    parser.add_argument('--binary', action='store_true', help='use the binary protocol')
+    parser.add_argument('--echo', action='store_true', help='keep the echo of echoing boards')
+    parser.add_argument('--devices', type=int, default=1, help='number of lightbars and of buzzers')
+    parser.add_argument('--probe', action='store_true',
+                        help='use the connected (or EMDR_PORTS emulated) devices instead of fake boards')
+    parser.add_argument('--direct', action='store_true', help='handle ticks on the timing thread')
+    parser.add_argument('--output', help='write JSON result to this file instead of stdout')
+    args = parser.parse_args(argv)
+    # keep stdout clean for the JSON result
+    with redirect_stdout(sys.stderr):
+        # the engine without UI, its ticks are handled on this thread
+        events = Queue()
+        session = Session(lambda kind, attrs: events.put((kind, attrs)), direct=args.direct)
+        # never touch the user's emdr.timing
+        session.recorder.filename = None
+        # exercise all outputs
+        session.set_light(True, 0x0f0000)
+        session.set_buzzer(True)
+        session.set_headphone(True)
+        Devices.binary_protocol = args.binary
+        Devices.disable_echo = not args.echo
+        if args.probe:
+            Devices.probe(True)
+            if not Devices._lightbars:
+                sys.exit('no lightbar found')
+        else:
+            attach(args.board, args.devices)
+        results = {
+            'board': args.board,
+            'protocol': 'binary' if args.binary else 'text',
+            'direct': args.direct,
+            'echo': Devices._lightbars[0][0]['echo'],
+            'devices': len(Devices._lightbars),
+            'led_num': Devices.led_num,
+            'python': sys.version.split()[0],
+            'results': [run_speed(session, events, int(s), args.seconds) for s in args.speeds.split(',')],
+        }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main_benchmark(sys.argv[1:])
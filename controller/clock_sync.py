@@ -0,0 +1,105 @@
+from collections import deque
+from threading import Lock
+
+class ClockSync():
+    # NTP style model of a device clock: the host sends 'T <seq>' and notes the time, the device
+    # answers 'T <seq> <ticks>' with the low 24 bits of its microsecond ticks, taken as read in the
+    # middle of the round trip, a line through the samples with the shortest round trips gives
+    # offset and drift, so host times can be sent as device times
+    wrap = 1 << 24
+    # a crystal is not off by more than this
+    max_drift = 0.001
+
+    def __init__(self, window=16, interval=2, fast_interval=0.1, needed=4, stale=4):
+        self.window = window
+        # seconds between syncs, fast_interval until needed samples are taken
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.needed = needed
+        # samples older than stale intervals are dropped when syncing resumes
+        self.stale = stale
+        self.lock = Lock()
+        self.seq = 0
+        self.sent = {}
+        # (host time, unwrapped device time in us, round trip)
+        self.samples = deque(maxlen=window)
+        # the fitted line goes through (host, device) with rate device us per host second
+        self.base = None
+        self.rate = 1e6
+        # half the shortest round trip, a bound of the offset error
+        self.error = None
+
+    def next_seq(self):
+        with self.lock:
+            self.seq = (self.seq + 1) & 0xffff
+            return self.seq
+
+    def next_interval(self):
+        return self.interval if self.synced() else self.fast_interval
+
+    def sent_at(self, seq, host):
+        with self.lock:
+            if len(self.sent) >= self.window:
+                # unanswered requests
+                self.sent.clear()
+            self.sent[seq] = host
+
+    def received(self, seq, ticks, host):
+        with self.lock:
+            start = self.sent.pop(seq, None)
+            if start is None:
+                return
+            rtt = host - start
+            middle = start + rtt / 2
+            if self.base is None:
+                device = ticks
+            else:
+                # the nearest device time with these low bits
+                expected = self.device_time(middle)
+                device = expected + (ticks - expected + self.wrap / 2) % self.wrap - self.wrap / 2
+            self.samples.append((middle, device, rtt))
+            self.fit()
+
+    def fit(self):
+        # the better half of the samples, with the shortest round trips
+        best = sorted(self.samples, key=lambda s: s[2])[:max(1, (len(self.samples) + 1) // 2)]
+        host = sum(s[0] for s in best) / len(best)
+        device = sum(s[1] for s in best) / len(best)
+        rate = 1e6
+        span = sum((s[0] - host) ** 2 for s in best)
+        if len(best) > 1 and span > 1:
+            rate = sum((s[0] - host) * (s[1] - device) for s in best) / span
+            if abs(rate / 1e6 - 1) > self.max_drift:
+                rate = 1e6
+        self.base = (host, device)
+        self.rate = rate
+        self.error = best[0][2] / 2
+
+    def resume(self, host):
+        # syncing starts again after an idle time, in which old samples drifted off by up to
+        # max_drift * idle time, they are dropped and synced() waits for needed fresh ones
+        with self.lock:
+            while self.samples and host - self.samples[0][0] > self.stale * self.interval:
+                self.samples.popleft()
+            if self.samples:
+                self.fit()
+
+    def device_time(self, host):
+        return self.base[1] + (host - self.base[0]) * self.rate
+
+    def synced(self):
+        return len(self.samples) >= self.needed
+
+    def to_device(self, host):
+        # low 24 bits of the device ticks at host time host
+        with self.lock:
+            return int(round(self.device_time(host))) % self.wrap
+
+    def stats(self):
+        with self.lock:
+            return {
+                'synced': self.synced(),
+                'samples': len(self.samples),
+                'error': self.error or 0,
+                'drift_ppm': (self.rate / 1e6 - 1) * 1e6,
+            }
@@ -0,0 +1,71 @@
+from config import Config
+from devices import Devices
+
+class Commands():
+    # the command language of the daemon and the control API:
+    # start [count], start24, stop, pause, resume, status, quit, speed <n>, profile <name>,
+    # light|buzzer|sound on|off, color <name>, intensity <n>, duration <n>, volume <n>, tone <name>
+    switches = {'light': 'lightbar.on', 'buzzer': 'buzzer.on', 'sound': 'headphone.on'}
+    choices = {
+        'speed': ('general.speed', Config.speeds),
+        'intensity': ('lightbar.intensity', Config.intensities),
+        'duration': ('buzzer.duration', Config.durations),
+        'volume': ('headphone.volume', Config.volumes),
+    }
+    named = {
+        'profile': ('general.profile', [(p,) for p in Config.profiles]),
+        'color': ('lightbar.color', Config.colors),
+        'tone': ('headphone.tone', Config.tones),
+    }
+
+    @classmethod
+    def parse(cls, line):
+        # returns (command, argument), a setting as ('set', (config key, value)),
+        # None for an empty line, raises ValueError for anything else
+        args = line.split()
+        if not args:
+            return None
+        cmd = args[0]
+        value = args[1] if len(args) > 1 else None
+        if cmd == 'start' and (not value or int(value) >= 0):
+            return 'start', int(value) if value else 0
+        if cmd == 'start24':
+            return 'start', 24
+        if cmd in ('stop', 'pause', 'resume', 'status', 'quit'):
+            return cmd, None
+        if cmd in cls.switches and value in ('on', 'off'):
+            return 'set', (cls.switches[cmd], value == 'on')
+        if cmd in cls.choices and value is not None and int(value) in cls.choices[cmd][1]:
+            return 'set', (cls.choices[cmd][0], int(value))
+        if cmd in cls.named:
+            key, values = cls.named[cmd]
+            for v in values:
+                if v[0] == value:
+                    return 'set', (key, v if len(v) > 1 else value)
+        raise ValueError(line)
+
+    @staticmethod
+    def status(session):
+        data = Config.data
+        return {
+            'mode': session.mode,
+            'counter': session.counter,
+            'speed': session.speed,
+            'profile': session.profile,
+            'light': data['lightbar.on'],
+            'buzzer': data['buzzer.on'],
+            'sound': data['headphone.on'],
+            'devices': {
+                'lightbar': Devices.lightbar_plugged_in(),
+                'buzzer': Devices.buzzer_plugged_in(),
+            },
+        }
+
+    @staticmethod
+    def format_status(status):
+        return 'status %s counter %d speed %d light %s buzzer %s sound %s lightbar %s buzzer %s' % (
+            status['mode'], status['counter'], status['speed'],
+            'on' if status['light'] else 'off', 'on' if status['buzzer'] else 'off',
+            'on' if status['sound'] else 'off',
+            'connected' if status['devices']['lightbar'] else 'missing',
+            'connected' if status['devices']['buzzer'] else 'missing')
@@ -1,7 +1,23 @@
-from threading import Lock
+from threading import Lock, Condition
+from _thread import start_new_thread
+from time import monotonic
+import atexit
+import json
+import os
 import pickle
+import sys
 
 class Config():
+    # settings are kept in a versioned JSON file, save() only marks them dirty,
+    # a background thread writes them when they did not change for delay seconds
+    version = 1
+    filename = 'emdr.config'
+    delay = 2
+    _lock = Lock()
+    _cond = Condition()
+    _dirty = False
+    _changed = 0
+    _writer = False
     colors = [
         ('white', 255, 255, 255),
         ('red', 255, 0, 0),
@@ -15,6 +31,9 @@ class Config():
     speeds = [
         10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 70, 80, 90, 100, 120, 140
     ]
+    profiles = [
+        'linear', 'ease-in', 'sine'
+    ]
     durations = [
         100, 200, 300, 400, 500, 600, 800, 1000
     ]
@@ -31,25 +50,95 @@ class Config():
     ]
     data = {
         'general.speed': 10,
+        'general.profile': 'linear',
         'lightbar.on': True,
         'lightbar.intensity': 20,
         'lightbar.color': colors[0],
+        'lightbar.tail': 0,
         'buzzer.on': True,
         'buzzer.duration': 100,
         'headphone.on': True,
         'headphone.volume': 0.5,
         'headphone.tone': tones[0],
+        # 'square', 'bandlimited' or 'sine'
+        'headphone.waveform': 'square',
+        # frames per second of the UI, and counter updates per second while a session runs
+        'ui.fps.config': 30,
+        'ui.fps.action': 10,
+        'ui.counter.rate': 4,
+        # local control API (started with 'api'), on loopback only, optionally on a unix socket too,
+        # state updates are pushed at most every interval seconds
+        'api.port': 8765,
+        'api.socket': '',
+        'api.interval': 0.02,
     }
 
     @classmethod
     def load(cls):
         try:
-            with open('emdr.config', 'rb') as f:
-                cls.data = pickle.load(f)
+            with open(cls.filename) as f:
+                stored = json.load(f)
+            if stored.get('version') == cls.version:
+                # JSON has no tuples, but the selectors compare with tuples
+                data = {key: tuple(value) if isinstance(value, list) else value
+                        for key, value in stored['data'].items()}
+                cls.data = dict(cls.data, **data)
+        except ValueError:
+            # not JSON, maybe the pickle of older versions
+            cls.load_pickle()
         except:
+            # missing, corrupt or from an older version
             pass
 
+    @classmethod
+    def load_pickle(cls):
+        # settings of older versions are merged over the defaults and rewritten as JSON
+        try:
+            with open(cls.filename, 'rb') as f:
+                stored = pickle.load(f)
+        except:
+            return
+        if isinstance(stored, dict):
+            cls.data = dict(cls.data, **stored)
+            cls.save()
+
     @classmethod
     def save(cls):
-        with open('emdr.config', 'wb') as f:
-            pickle.dump(cls.data, f)
+        with cls._cond:
+            cls._dirty = True
+            cls._changed = monotonic()
+            if not cls._writer:
+                cls._writer = True
+                atexit.register(cls.flush)
+                start_new_thread(cls.write_behind, (()))
+            cls._cond.notify()
+
+    @classmethod
+    def write_behind(cls):
+        while True:
+            with cls._cond:
+                while not cls._dirty:
+                    cls._cond.wait()
+                # coalesce changes until they settle
+                while monotonic() - cls._changed < cls.delay:
+                    cls._cond.wait(cls.delay - (monotonic() - cls._changed))
+            cls.flush()
+
+    @classmethod
+    def flush(cls):
+        # write pending changes now, atomically: a crash leaves the old or the new file
+        with cls._lock:
+            with cls._cond:
+                if not cls._dirty:
+                    return
+                cls._dirty = False
+                data = dict(cls.data)
+            tmp = cls.filename + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump({'version': cls.version, 'data': data}, f, indent=1)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, cls.filename)
+            except OSError as e:
+                print('saving config failed: %s' % e, file=sys.stderr)
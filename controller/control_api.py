@@ -0,0 +1,129 @@
+import asyncio
+import json
+import sys
+from threading import Lock
+from _thread import start_new_thread
+
+class ControlServer():
+    # local control API on its own asyncio thread: clients send JSON lines
+    # {"id": .., "cmd": "speed", "value": 60} and get {"id": .., "reply": ..} or {"id": .., "error": ..},
+    # after {"cmd": "subscribe", "topics": [..]} the latest 'mode', 'counter' and 'position' are pushed
+    # as {"event": topic, "value": ..}, handle(line, done) has to run the command line on the thread
+    # owning the session and call done(reply), publish(what, value) is an observer of the session,
+    # a line that is not a JSON object closes the connection, so a web page posting to the port
+    # (HTTP headers first) never gets to a command
+    topics = ('mode', 'counter', 'position')
+    # clients not reading their events are dropped instead of buffering for them
+    max_buffer = 64 * 1024
+
+    def __init__(self, handle, port=8765, path=None, interval=0.02):
+        self.handle = handle
+        self.port = port
+        self.path = path
+        self.interval = interval
+        # writer -> subscribed topics
+        self.clients = {}
+        # values published since the last push
+        self.latest = {}
+        self.lock = Lock()
+        self.state = {}
+        self.posted = False
+        self.pushed = 0
+        self.loop = asyncio.new_event_loop()
+        start_new_thread(self.run, (()))
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            if self.port:
+                self.loop.run_until_complete(asyncio.start_server(self.client, '127.0.0.1', self.port))
+            if self.path:
+                self.loop.run_until_complete(asyncio.start_unix_server(self.client, self.path))
+        except OSError as e:
+            print('control api not started: %s' % e, file=sys.stderr)
+            return
+        self.loop.run_forever()
+
+    def publish(self, what, value):
+        # called on any thread, even the timing thread: only notes the value and wakes the
+        # event loop once per push
+        with self.lock:
+            self.latest[what] = value
+            if self.posted:
+                return
+            self.posted = True
+        try:
+            self.loop.call_soon_threadsafe(self.schedule)
+        except RuntimeError:
+            # loop closed
+            pass
+
+    def schedule(self):
+        self.loop.call_later(max(0, self.pushed + self.interval - self.loop.time()), self.push)
+
+    def push(self):
+        with self.lock:
+            self.posted = False
+            latest, self.latest = self.latest, {}
+        self.pushed = self.loop.time()
+        self.state.update(latest)
+        for writer, topics in list(self.clients.items()):
+            for what in self.topics:
+                if what in latest and what in topics:
+                    self.send(writer, {'event': what, 'value': latest[what]})
+
+    def send(self, writer, message):
+        if writer not in self.clients:
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            del self.clients[writer]
+            writer.close()
+            return
+        writer.write(json.dumps(message).encode() + b'\n')
+
+    async def client(self, reader, writer):
+        self.clients[writer] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError()
+                except ValueError:
+                    self.send(writer, {'error': 'invalid request'})
+                    break
+                self.request(writer, request)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError, TypeError):
+            pass
+        self.clients.pop(writer, None)
+        writer.close()
+
+    def request(self, writer, request):
+        id = request.get('id')
+        cmd = str(request.get('cmd', ''))
+        if cmd in ('subscribe', 'unsubscribe'):
+            topics = set(request.get('topics') or self.topics) & set(self.topics)
+            if cmd == 'subscribe':
+                self.clients[writer] |= topics
+            else:
+                self.clients[writer] -= topics
+            self.send(writer, {'id': id, 'reply': sorted(self.clients[writer])})
+            # start with the current state
+            for what in self.topics:
+                if cmd == 'subscribe' and what in topics and what in self.state:
+                    self.send(writer, {'event': what, 'value': self.state[what]})
+            return
+        value = request.get('value')
+        line = cmd if value is None else '%s %s' % (cmd, value)
+
+        def done(reply):
+            # called on the thread of the session
+            if isinstance(reply, str) and reply.startswith('error'):
+                message = {'id': id, 'error': reply[6:] or cmd}
+            else:
+                message = {'id': id, 'reply': reply}
+            self.loop.call_soon_threadsafe(self.send, writer, message)
+        self.handle(line, done)
@@ -0,0 +1,115 @@
+import sys
+from queue import Queue
+from _thread import start_new_thread
+from config import Config
+from devices import Devices
+from hotplug import HotplugMonitor
+from session import Session
+from commands import Commands
+from control_api import ControlServer
+
+class Daemon():
+    # runs sessions without display, controlled by commands read line by line from input,
+    # one thread handles commands, ticks (unless direct) and device changes
+    def __init__(self, autonomous=False, hotplug=True, input=sys.stdin, output=sys.stdout, direct=False, api=False):
+        self.output = output
+        self.events = Queue()
+        self.running = True
+        self.session = Session(self.post, autonomous, direct)
+        self.session.observers.append(self.session_changed)
+        Config.load()
+        self.apply_config()
+        self.session.end()
+        self.session.reset()
+        if hotplug:
+            HotplugMonitor(lambda: self.post('probe', {}))
+        if api:
+            # commands of API clients run on our thread like the ones from input
+            server = ControlServer(lambda line, done: self.post('api', {'line': line, 'done': done}),
+                                   Config.data['api.port'], Config.data['api.socket'], Config.data['api.interval'])
+            self.session.observers.append(server.publish)
+            server.publish('mode', self.session.mode)
+            server.publish('counter', self.session.counter)
+        start_new_thread(self.read_commands, (input,))
+
+    def post(self, kind, attrs):
+        self.events.put((kind, attrs))
+
+    def reply(self, line):
+        print(line, file=self.output, flush=True)
+
+    def apply_config(self):
+        data = Config.data
+        Devices.set_buzzer_duration(data['buzzer.duration'])
+        (tone_name, frequency, duration) = data['headphone.tone']
+        volume = data['headphone.volume'] if data['headphone.volume'] in Config.volumes else Config.volumes[0]
+        Devices.set_tone(frequency, duration, volume / 100, data.get('headphone.waveform', 'square'))
+        color = Session.light_color(data['lightbar.color'], data['lightbar.intensity'])
+        Devices.set_tail(data.get('lightbar.tail', 0))
+        Devices.set_color(color)
+        self.session.set_profile(data.get('general.profile', 'linear'))
+        self.session.set_speed(data['general.speed'])
+        self.session.set_light(data['lightbar.on'], color)
+        self.session.set_buzzer(data['buzzer.on'])
+        self.session.set_headphone(data['headphone.on'])
+
+    def read_commands(self, input):
+        for line in input:
+            self.post('command', {'line': line})
+        # no more commands, keep running until stopped otherwise
+
+    def session_changed(self, what, value):
+        if what != 'position':
+            self.reply('%s %s' % (what, value))
+
+    def command(self, line):
+        # runs a command (see Commands), returns the reply, None for an empty line
+        try:
+            parsed = Commands.parse(line)
+        except ValueError:
+            return 'error %s' % line.strip()
+        if parsed is None:
+            return None
+        cmd, arg = parsed
+        if cmd == 'start':
+            self.session.start(arg)
+        elif cmd == 'stop':
+            self.session.stop()
+        elif cmd == 'pause':
+            self.session.pause()
+        elif cmd == 'resume':
+            self.session.resume()
+        elif cmd == 'status':
+            return Commands.status(self.session)
+        elif cmd == 'quit':
+            self.running = False
+        elif cmd == 'set':
+            key, value = arg
+            Config.data[key] = value
+            self.changed()
+        return 'ok'
+
+    def changed(self):
+        self.apply_config()
+        Config.save()
+
+    def run(self):
+        try:
+            while self.running:
+                kind, attrs = self.events.get()
+                if kind == 'action':
+                    self.session.action(**attrs)
+                elif kind == 'sweep':
+                    self.session.sweep(**attrs)
+                elif kind == 'probe':
+                    self.reply(Commands.format_status(Commands.status(self.session)))
+                elif kind == 'command':
+                    reply = self.command(attrs['line'])
+                    if reply is not None:
+                        self.reply(Commands.format_status(reply) if isinstance(reply, dict) else reply)
+                elif kind == 'api':
+                    attrs['done'](self.command(attrs['line']))
+        except KeyboardInterrupt:
+            pass
+        self.session.end()
+        Config.flush()
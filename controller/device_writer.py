@@ -0,0 +1,225 @@
+from collections import deque
+from threading import Condition
+from _thread import start_new_thread
+from time import perf_counter
+from clock_sync import ClockSync
+
+class DeviceWriter():
+    # owns the serial port of one device and writes queued commands on its own thread,
+    # so a slow USB transaction never blocks the caller, a second thread reads the
+    # echoes of echoing boards and any other line the device reports
+    def __init__(self, dev, ser, listener=None, line_listener=None, size=16, window=4, echo_timeout=0.5,
+                 sync_burst=1):
+        self.dev = dev
+        self.ser = ser
+        # listener(tag, time) is called when a tagged command has been written
+        self.listener = listener
+        # line_listener(dev, tokens) is called for lines that are not an echo
+        self.line_listener = line_listener
+        self.size = size
+        self.queue = deque()
+        # echoes still to come, at most window commands are sent ahead of their echo
+        self.window = window
+        self.echo_timeout = echo_timeout
+        self.pending = deque()
+        self.cond = Condition()
+        self.alive = True
+        # binary frame buffer, reused for every command
+        self.frame = bytearray(5)
+        self.seq = 0
+        # devices announcing 'sync' execute commands at a given time of their clock
+        self.clock = ClockSync() if b'sync' in dev.get('caps', ()) else None
+        self.next_sync = 0
+        # the clock is synced in a burst after connecting and during sessions (see set_syncing),
+        # an idle controller does no serial I/O
+        self.sync_until = perf_counter() + sync_burst
+        self.syncing = False
+        self.reset_stats()
+        # the reader blocks until a line arrives, close() cancels it
+        self.ser.timeout = None
+        start_new_thread(self.loop, (()))
+        start_new_thread(self.read_loop, (()))
+
+    def submit(self, cmd, val=None, key=None, tag=None, at=None):
+        # non-blocking, an unsent command with the same key is removed and the new one queued
+        # at the end, so commands submitted in between (like a colour) still go first,
+        # commands without key (like buzzer pulses) are never dropped,
+        # a synced device executes the command at host time at, others at once
+        with self.cond:
+            if not self.alive:
+                return False
+            entry = (cmd, val, key, tag, perf_counter(), at)
+            if key is not None:
+                for i, queued in enumerate(self.queue):
+                    if queued[2] == key:
+                        del self.queue[i]
+                        self.queue.append(entry)
+                        self.coalesced += 1
+                        self.cond.notify()
+                        return True
+            if len(self.queue) >= self.size:
+                # make room by dropping the oldest droppable command,
+                # a queue full of pulses grows beyond its size instead
+                droppable = [queued for queued in self.queue if queued[2] is not None]
+                if droppable:
+                    self.queue.remove(droppable[0])
+                    self.drops += 1
+                elif key is not None:
+                    self.drops += 1
+                    return False
+            self.queue.append(entry)
+            self.cond.notify()
+        return True
+
+    def set_syncing(self, on):
+        # keep syncing the clock while there is nothing else to write, samples of before an
+        # idle time are dropped, so the device is not synced until fresh ones are taken
+        with self.cond:
+            if on and not self.syncing:
+                self.clock.resume(perf_counter())
+                self.next_sync = 0
+            self.syncing = on
+            self.cond.notify()
+
+    def encode(self, cmd, val):
+        if self.dev.get('binary'):
+            # opcode (command letter | 0x80), sequence, 24 bit payload
+            val = int(val or 0)
+            self.seq = (self.seq + 1) & 0xff
+            frame = self.frame
+            frame[0] = cmd[0] | 0x80
+            frame[1] = self.seq
+            frame[2] = (val >> 16) & 0xff
+            frame[3] = (val >> 8) & 0xff
+            frame[4] = val & 0xff
+            return frame
+        elif val is None:
+            return cmd + b'\r\n'
+        else:
+            return b'%s %d\r\n' % (cmd, val)
+
+    def encode_at(self, ticks, data):
+        # data to be executed at device time ticks (low 24 bits of its microsecond ticks)
+        if self.dev.get('binary'):
+            data = bytes(data)
+            return bytes(self.encode(b'@', ticks)) + data
+        return b'@%d %s' % (ticks, data)
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.alive and not self.queue:
+                    if self.clock is None or not (self.syncing or perf_counter() < self.sync_until):
+                        self.cond.wait()
+                        continue
+                    # sync the clock while there is nothing else to write
+                    wait = self.next_sync - perf_counter()
+                    if wait > 0:
+                        self.cond.wait(wait)
+                    else:
+                        self.queue.append((b'T', self.clock.next_seq(), None, None, perf_counter(), None))
+                        self.next_sync = perf_counter() + self.clock.next_interval()
+                while self.alive and len(self.pending) >= self.window:
+                    # too many echoes outstanding, give up on the oldest one after a while
+                    if not self.cond.wait(self.echo_timeout) and self.pending:
+                        self.pending.popleft()
+                        self.echo_errors += 1
+                if not self.alive:
+                    return
+                cmd, val, key, tag, submitted, at = self.queue.popleft()
+                data = self.encode(cmd, val)
+                if at is not None and self.clock is not None and self.clock.synced():
+                    data = self.encode_at(self.clock.to_device(at), data)
+                if self.dev['echo']:
+                    self.pending.append(data.strip())
+            if cmd == b'T':
+                self.clock.sent_at(val, perf_counter())
+            try:
+                self.ser.write(data)
+                self.ser.flush()
+            except:
+                # device gone
+                self.close()
+                return
+            done = perf_counter()
+            self.written += 1
+            self.latency = done - submitted
+            self.max_latency = max(self.max_latency, self.latency)
+            self.sum_latency += self.latency
+            if tag is not None and self.listener:
+                self.listener(tag, done)
+
+    def read_loop(self):
+        while self.alive:
+            try:
+                line = self.ser.read_until().strip()
+                received = perf_counter()
+            except:
+                # device gone
+                self.close()
+                return
+            if not line:
+                continue
+            with self.cond:
+                if line in self.pending:
+                    # echoes of commands before this one got lost
+                    while self.pending.popleft() != line:
+                        self.echo_errors += 1
+                    self.cond.notify()
+                    continue
+            if line.startswith(b'T ') and self.clock is not None:
+                # answer of a clock sync: T <seq> <ticks>
+                try:
+                    _, seq, ticks = line.split()
+                    self.clock.received(int(seq), int(ticks), received)
+                except ValueError:
+                    self.errors += 1
+                continue
+            if line.startswith(b'error'):
+                self.errors += 1
+            elif line.startswith(b'busy'):
+                # buzzer pulse requested while that channel was still active
+                self.busy += 1
+            if self.line_listener:
+                self.line_listener(self.dev, line.split())
+
+    def close(self):
+        with self.cond:
+            if not self.alive:
+                return
+            self.alive = False
+            self.cond.notify_all()
+        try:
+            self.ser.cancel_read()
+            self.ser.close()
+        except:
+            pass
+
+    def reset_stats(self):
+        self.written = 0
+        self.coalesced = 0
+        self.drops = 0
+        self.latency = 0
+        self.max_latency = 0
+        self.sum_latency = 0
+        self.echo_errors = 0
+        self.errors = 0
+        self.busy = 0
+
+    def stats(self):
+        stats = {
+            'depth': len(self.queue),
+            'outstanding': len(self.pending),
+            'echo_errors': self.echo_errors,
+            'errors': self.errors,
+            'busy': self.busy,
+            'written': self.written,
+            'coalesced': self.coalesced,
+            'drops': self.drops,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+            'avg_latency': self.sum_latency / self.written if self.written else 0,
+        }
+        if self.clock is not None:
+            stats['clock'] = self.clock.stats()
+        return stats
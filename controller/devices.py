@@ -1,25 +1,17 @@
 from serial import Serial
 from serial.tools.list_ports import comports
+from serial.tools.list_ports_common import ListPortInfo
 import pygame
-from array import array
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+import os
+import sys
 from device_config import DEVICE_CONFIG
-
-class Note(pygame.mixer.Sound):
-    def __init__(self, frequency, volume=.33):
-        self.frequency = frequency
-        super().__init__(buffer=self.build_samples())
-        self.set_volume(volume)
-
-    def build_samples(self):
-        period = int(round(pygame.mixer.get_init()[0] / self.frequency))
-        samples = array("h", [0] * period)
-        amplitude = 2 ** (abs(pygame.mixer.get_init()[1]) - 1) - 1
-        for time in range(period):
-            if time < period / 2:
-                samples[time] = amplitude
-            else:
-                samples[time] = -amplitude
-        return samples
+from device_writer import DeviceWriter
+from tones import ToneBank
+from sound_stream import SoundStream
+from skew import SkewStats
 
 class Devices():
     led_num = 57
@@ -30,90 +22,358 @@ class Devices():
     _channel_left.set_volume(1, 0)
     _channel_right = pygame.mixer.Channel(1)
     _channel_right.set_volume(0, 1)
-    _beep = Note(440)
-    _sound_duration = 50
-    _lightbar = (None, None)
-    _buzzer = (None, None)
-
-    @classmethod
-    def probe(cls):
-        _, ser = cls._lightbar
-        if ser:
-            ser.close()
-        cls._lightbar = (None, None)
-        _, ser = cls._buzzer
-        if ser:
-            ser.close()
-        cls._buzzer = (None, None)
-        for p in comports():
+    _tones = ToneBank()
+    _tone = (440, 50, 'square')
+    _beep = _tones.get(*_tone)
+    _audio_buffer = 1024
+    _stream = SoundStream(pygame.mixer.Channel(3))
+    _stream.set_beep(_beep, 1)
+    _volume = 1
+    # seconds from do_sound until the beep is heard, see estimate_audio
+    audio_latency = 0
+    # every step is broadcast to all devices of a role, each written by its own writer thread
+    _lightbars = []
+    _buzzers = []
+    # mirrored devices should not write a step further apart than this many seconds
+    skew_tolerance = 0.002
+    _skew = {'lightbar': SkewStats(skew_tolerance), 'buzzer': SkewStats(skew_tolerance)}
+    # ids of broadcast steps, send is called from the timing and the host thread,
+    # next() of a count is atomic where += is not
+    _steps = count(1)
+    # steps are sent this many seconds ahead to devices that execute them on their own clock
+    schedule_ahead = 0.005
+    # port path -> (vid/pid/serial number, role, connection) of every probed port
+    _ports = {}
+    _dev_mtime = None
+    _retry_at = 0
+    # ports that did not answer (e.g. still booting) are asked again after this many seconds
+    retry_interval = 5
+    # the firmware takes the count of an autonomous sweep as one byte
+    max_sweep_count = 0xff
+    # opt-in binary frames for firmware announcing the 'bin' capability
+    binary_protocol = False
+    # switch off the echo of firmware announcing the 'noecho' capability
+    disable_echo = True
+    _sweep_listener = None
+    # write_listener(tag, time) is called from the writer threads for tagged commands
+    write_listener = None
+    # records the device commands when set, see session_trace.TraceRecorder
+    tracer = None
+    _sweep_events = {b'L': 'left', b'R': 'right', b'M': 'middle', b'E': 'end'}
+
+    @classmethod
+    def probe(cls, force=False):
+        # incremental: only new or changed ports are opened and asked for their id (in parallel),
+        # known devices stay connected, force skips the shortcut on an unchanged /dev
+        try:
+            dev_mtime = os.stat('/dev').st_mtime_ns
+        except OSError:
+            dev_mtime = None
+        now = monotonic()
+        alive = all(devser[1].alive for _, _, devser in cls._ports.values() if devser)
+        retry = now >= cls._retry_at and any(role is None for _, role, _ in cls._ports.values())
+        if not force and dev_mtime is not None and dev_mtime == cls._dev_mtime and alive and not retry:
+            # no device node added or removed, nothing to do
+            return
+        cls._dev_mtime = dev_mtime
+        ports = {}
+        for p in comports() + cls.extra_ports():
             for d in DEVICE_CONFIG.values():
                 if (p.vid, p.pid) == (d['vid'], d['pid']):
-                    ser = None
-                    try:
-                        ser = Serial(p.device, baudrate=d['baud'], timeout=0.1)
-                        ser.write(b'i\r\n')
-                        ser.flush()
-                        if d['echo']:
-                            ser.read_until()
-                        id_str = ser.read_until().strip()
-                        if id_str.find(b'EMDR Lightbar') == 0:
-                            cls._lightbar = (d, ser)
-                        elif id_str.find(b'EMDR Buzzer') == 0:
-                            cls._buzzer = (d, ser)
-                        else:
-                            ser.close()
-                    except:
-                        if ser:
-                            ser.close()
-                        pass
+                    ports[p.device] = (p, d)
+        # forget vanished, changed and dead devices, retry failed ones after a while
+        for device, (signature, role, devser) in list(cls._ports.items()):
+            p = ports.get(device)
+            if (p is None or cls.signature(p[0]) != signature or (devser and not devser[1].alive)
+                    or (role is None and now >= cls._retry_at)):
+                if devser:
+                    devser[1].close()
+                del cls._ports[device]
+        new = [(p, d) for device, (p, d) in ports.items() if device not in cls._ports]
+        if new:
+            with ThreadPoolExecutor(max_workers=len(new)) as pool:
+                for (p, d), (role, devser) in zip(new, pool.map(lambda pd: cls.handshake(*pd), new)):
+                    cls._ports[p.device] = (cls.signature(p), role, devser)
+        cls._retry_at = now + cls.retry_interval
+        cls._lightbars = [devser for _, (_, role, devser) in sorted(cls._ports.items()) if role == 'lightbar']
+        cls._buzzers = [devser for _, (_, role, devser) in sorted(cls._ports.items()) if role == 'buzzer']
+
+    @staticmethod
+    def extra_ports():
+        # ports the system does not list as USB devices, e.g. the ptys of emulated boards:
+        # EMDR_PORTS=<path>=<board>,.. with the board names of DEVICE_CONFIG
+        ports = []
+        for entry in filter(None, os.environ.get('EMDR_PORTS', '').split(',')):
+            device, _, board = entry.partition('=')
+            if board not in DEVICE_CONFIG:
+                print('unknown board %s of port %s' % (board, device), file=sys.stderr)
+                continue
+            p = ListPortInfo(device, skip_link_detection=True)
+            p.vid = DEVICE_CONFIG[board]['vid']
+            p.pid = DEVICE_CONFIG[board]['pid']
+            p.serial_number = device
+            ports.append(p)
+        return ports
+
+    @classmethod
+    def retry_due_in(cls):
+        # seconds until ports that did not answer are asked again, None if there are none
+        if any(role is None for _, role, _ in cls._ports.values()):
+            return max(0, cls._retry_at - monotonic())
+        return None
+
+    @staticmethod
+    def signature(p):
+        return (p.vid, p.pid, p.serial_number)
+
+    @classmethod
+    def handshake(cls, p, d):
+        # returns role and connection of an EMDR device, (None, None) for anything else
+        ser = None
+        try:
+            ser = Serial(p.device, baudrate=d['baud'], timeout=0.1)
+            ser.write(b'i\r\n')
+            ser.flush()
+            id_str = ser.read_until().strip()
+            if d['echo'] and id_str.find(b'EMDR') != 0:
+                # skip the echo, unless it was switched off before
+                id_str = ser.read_until().strip()
+            if id_str.find(b'EMDR Lightbar') == 0:
+                return 'lightbar', cls.open(cls.negotiate(d, ser, id_str[13:].split()), ser)
+            elif id_str.find(b'EMDR Buzzer') == 0:
+                return 'buzzer', cls.open(cls.negotiate(d, ser, id_str[11:].split()), ser)
+            else:
+                ser.close()
+        except:
+            if ser:
+                ser.close()
+        return None, None
+
+    @classmethod
+    def negotiate(cls, d, ser, caps):
+        # returns the per connection device description
+        if cls.binary_protocol and b'bin' in caps:
+            if cls.acknowledged(d, ser, b'b 1\r\n'):
+                # no echo in binary mode
+                return dict(d, caps=caps, echo=False, binary=True)
+        if cls.disable_echo and d['echo'] and b'noecho' in caps:
+            if cls.acknowledged(d, ser, b'e 0\r\n'):
+                return dict(d, caps=caps, echo=False)
+        return dict(d, caps=caps)
+
+    @classmethod
+    def acknowledged(cls, d, ser, cmd):
+        ser.write(cmd)
+        ser.flush()
+        ack = ser.read_until().strip()
+        if d['echo'] and ack != b'ok':
+            # skip the echo, unless it was switched off before
+            ack = ser.read_until().strip()
+        return ack == b'ok'
+
+    @classmethod
+    def open(cls, dev, ser):
+        return (dev, DeviceWriter(dev, ser, lambda tag, time: cls.written(ser.port, tag, time), cls.received))
+
+    @classmethod
+    def written(cls, device, tag, time):
+        # tag = (role, step, devices, tag of the caller) for steps broadcast by send
+        role, step, devices, tag = tag
+        if devices > 1:
+            cls._skew[role].written(device, step, devices, time)
+        if tag is not None and cls.write_listener:
+            # with several devices the last write of the step is reported last
+            cls.write_listener(tag, time)
 
     @classmethod
     def lightbar_plugged_in(cls):
-        return cls._lightbar != (None, None)
+        return len(cls._lightbars) > 0
 
     @classmethod
     def buzzer_plugged_in(cls):
-        return cls._buzzer != (None, None)
+        return len(cls._buzzers) > 0
 
     @classmethod
-    def write(cls, devser, cmd):
-        (dev, ser) = devser
-        if dev and ser:
-            ser.write(cmd)
-            ser.flush()
-            if dev['echo']:
-                ser.read_until().strip()
+    def lightbar_autonomous(cls):
+        # bars sweeping on their own would drift apart, so only a single one may
+        return len(cls._lightbars) == 1 and b'auto' in cls._lightbars[0][0]['caps']
+
+    @classmethod
+    def send(cls, role, cmd, val=None, key=None, tag=None, caps=None, at=None):
+        # non-blocking, broadcast to all devices of the role (with capability caps),
+        # executed at host time at by synced devices,
+        # returns False if the command was dropped by any of them
+        devices = [writer for dev, writer in (cls._lightbars if role == 'lightbar' else cls._buzzers)
+                   if writer and (caps is None or caps in dev['caps'])]
+        if not devices:
+            return False
+        step = (role, next(cls._steps), len(devices), tag)
+        sent = True
+        for writer in devices:
+            sent = writer.submit(cmd, val, key, step, at) and sent
+        return sent
+
+    @classmethod
+    def schedule_lead(cls):
+        # how far ahead of their time steps can be sent, only if every device executes them on time
+        writers = [writer for _, writer in cls._lightbars + cls._buzzers if writer]
+        if writers and all(writer.clock is not None and writer.clock.synced() for writer in writers):
+            return cls.schedule_ahead
+        return 0
+
+    @classmethod
+    def set_clock_sync(cls, on):
+        # sync the device clocks during a session only
+        for _, writer in cls._lightbars + cls._buzzers:
+            if writer and writer.clock is not None:
+                writer.set_syncing(on)
+
+    @classmethod
+    def stats(cls):
+        # queue depth, drops and write latency per device, skew between mirrored devices, which is
+        # the spread of the times the host finished writing a step to them (host-side write skew),
+        # not of the times their leds changed
+        result = {}
+        for role, devices in (('lightbar', cls._lightbars), ('buzzer', cls._buzzers)):
+            for i, (_, writer) in enumerate(devices):
+                if writer:
+                    result[role + (str(i + 1) if i else '')] = writer.stats()
+            if len(devices) > 1:
+                result[role + '.skew'] = cls._skew[role].stats()
+        return result
 
+    @classmethod
+    def reset_stats(cls):
+        for _, writer in cls._lightbars + cls._buzzers:
+            if writer:
+                writer.reset_stats()
+        for skew in cls._skew.values():
+            skew.reset()
 
     @classmethod
-    def set_led(cls, num):
+    def set_led(cls, num, tag=None, at=None):
+        # a new led position supersedes an unsent one
+        if cls.tracer:
+            cls.tracer.set_led(num)
         if num >= 0:
-            cls.write(cls._lightbar, b'l %d\r\n' % num)
+            cls.send('lightbar', b'l', num, b'l', tag, at=at)
         else:
-            cls.write(cls._lightbar, b't\r\n')
+            cls.send('lightbar', b't', None, b'l', tag, at=at)
 
     @classmethod
     def set_color(cls, col):
-        cls.write(cls._lightbar, b'c %d\r\n' % col)
+        if cls.tracer:
+            cls.tracer.set_color(col)
+        cls.send('lightbar', b'c', col, b'c')
+
+    @classmethod
+    def set_tail(cls, length):
+        # fading tail behind the led, drawn by the firmware
+        cls.send('lightbar', b'f', length, b'f', caps=b'tail')
+
+    @classmethod
+    def received(cls, dev, tokens):
+        # lines reported by a device, called from its reader thread
+        listener = cls._sweep_listener
+        if tokens[0] in cls._sweep_events and listener:
+            listener(cls._sweep_events[tokens[0]], int(tokens[1]) if len(tokens) > 1 else 0)
+
+    @classmethod
+    def start_sweep(cls, speed, col, count, listener):
+        # let the lightbar sweep on its own, listener(kind, counter) is called from the reader thread
+        # for kind 'left', 'right', 'middle' and 'end', starting a halting sweep resumes it,
+        # count up to max_sweep_count
+        cls.set_color(col)
+        cls._sweep_listener = listener
+        cls.send('lightbar', b's', speed | count << 8 | 1 << 16)
+
+    @classmethod
+    def set_sweep_speed(cls, speed):
+        cls.send('lightbar', b'v', speed, b'v')
+
+    @classmethod
+    def halt_sweep(cls):
+        # decay and stop in the middle
+        cls.send('lightbar', b'h')
+
+    @classmethod
+    def stop_sweep(cls):
+        cls._sweep_listener = None
 
     @classmethod
     def set_buzzer_duration(cls, duration):
         cls._buzzer_duration = duration
 
     @classmethod
-    def do_buzzer(cls, left):
-        cls.write(cls._buzzer, (b'l' if left else b'r') + b' %d\r\n' % cls._buzzer_duration)
+    def do_buzzer(cls, left, at=None):
+        if cls.tracer:
+            cls.tracer.do_buzzer(left, cls._buzzer_duration)
+        cls.send('buzzer', b'l' if left else b'r', cls._buzzer_duration, at=at)
+
+    @classmethod
+    def init_audio(cls, buffer):
+        # reopen the mixer with another buffer size, smaller buffers mean less latency
+        if buffer == cls._audio_buffer:
+            return
+        pygame.mixer.quit()
+        pygame.mixer.init(44100, -16, 2, buffer)
+        cls._audio_buffer = buffer
+        left, right = cls._channel_left.get_volume(), cls._channel_right.get_volume()
+        cls._channel_left = pygame.mixer.Channel(0)
+        cls._channel_left.set_volume(left, 0)
+        cls._channel_right = pygame.mixer.Channel(1)
+        cls._channel_right.set_volume(0, right)
+        cls._tones.clear()
+        cls._beep = cls._tones.get(*cls._tone)
+        cls._stream.set_channel(pygame.mixer.Channel(3))
+        cls._stream.set_beep(cls._beep, cls._volume)
+
+    @classmethod
+    def estimate_audio(cls):
+        # an estimate from the mixer settings, not a measurement of the output: the mixer fills
+        # one buffer while the audio device plays the one before, so a beep is heard about two
+        # buffers after do_sound, plus whatever the audio driver adds
+        rate = pygame.mixer.get_init()[0]
+        cls.audio_latency = 2 * cls._audio_buffer / rate
+        return cls.audio_latency
 
     @classmethod
     def do_sound(cls, left):
+        if cls.tracer:
+            cls.tracer.do_sound(left)
         if left:
-            cls._channel_left.play(cls._beep, cls._sound_duration)
+            cls._channel_left.play(cls._beep)
         else:
-            cls._channel_right.play(cls._beep, cls._sound_duration)
+            cls._channel_right.play(cls._beep)
+
+    @classmethod
+    def sync_sound(cls, elapsed, at, half):
+        # beep at the ends from a continuous stream, at time at elapsed seconds have passed since
+        # the left end, half seconds pass from end to end, beeps are started ahead by the audio latency
+        if cls.tracer:
+            cls.tracer.sync_sound(elapsed, at, half)
+        cls._stream.sync(elapsed, at, half, cls.audio_latency)
+
+    @classmethod
+    def stop_sound(cls, at=None):
+        # stop the stream now, or after the beep of the end reached at time at
+        if cls.tracer:
+            cls.tracer.stop_sound(at)
+        cls._stream.stop(at)
+
+    @classmethod
+    def preload_tones(cls, tones, waveform='square'):
+        # render (frequency, duration) pairs ahead of use
+        for frequency, duration in tones:
+            cls._tones.get(frequency, duration, waveform)
 
     @classmethod
-    def set_tone(cls, frequency, duration, volume):
-        cls._beep = Note(frequency)
-        cls._sound_duration = duration
+    def set_tone(cls, frequency, duration, volume, waveform='square'):
+        if cls.tracer:
+            cls.tracer.set_tone(frequency, duration, volume, waveform)
+        cls._tone = (frequency, duration, waveform)
+        cls._beep = cls._tones.get(*cls._tone)
+        cls._volume = volume
+        cls._stream.set_beep(cls._beep, volume)
         cls._channel_left.set_volume(1 * volume, 0)
         cls._channel_right.set_volume(0, 1 * volume)
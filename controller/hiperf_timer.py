@@ -1,5 +1,6 @@
 from time import perf_counter, sleep
 from _thread import start_new_thread
+from threading import Condition
 
 class HighPerfTimer():
     def __init__(self, delay, action):
@@ -19,3 +20,91 @@ class HighPerfTimer():
             sleep(0)
         # now call back
         self.action()
+
+class SessionScheduler():
+    # one long-lived thread calling back at absolute deadlines anchor + n * delay,
+    # so callback latency never accumulates into the session timing, the callback for
+    # a deadline comes lead seconds early (for devices executing it on time on their own),
+    # next_delay(deadline) is called when a tick fires and returns the delay before the
+    # following one (None keeps the delay), so it never depends on when the action is handled
+    def __init__(self, action, lead=0, next_delay=None):
+        self.action = action
+        self.lead = lead
+        self.next_delay = next_delay
+        self.cond = Condition()
+        self.running = False
+        self.generation = 0
+        self.delay = 0
+        self.anchor = 0
+        self.tick = 0
+        self.missed = 0
+        self.max_late = 0
+        start_new_thread(self.loop, (()))
+
+    def start(self, delay):
+        with self.cond:
+            self.generation += 1
+            self.delay = delay
+            self.anchor = perf_counter()
+            self.tick = 1
+            self.missed = 0
+            self.max_late = 0
+            self.running = True
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.generation += 1
+            self.running = False
+            self.cond.notify()
+
+    def set_delay(self, delay):
+        # re-anchor at the last deadline, so a new delay applies from the next tick on
+        with self.cond:
+            if delay != self.delay:
+                self.anchor += (self.tick - 1) * self.delay
+                # a shorter delay whose first deadline has passed fires once at once, not in a burst
+                self.anchor = max(self.anchor, perf_counter() - delay)
+                self.tick = 1
+                self.delay = delay
+                # wake the loop, which waits for the deadline of the old delay
+                self.cond.notify()
+
+    def deadline(self):
+        return self.anchor + self.tick * self.delay
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while not self.running:
+                    self.cond.wait()
+                generation = self.generation
+                deadline = self.deadline()
+                fire = deadline - self.lead
+                # cpu friendly wait for more than 10 ms, interruptible by stop() and set_delay(),
+                # the deadline is recomputed after any wakeup
+                remaining = fire - perf_counter()
+                if remaining > 10 / 1000:
+                    self.cond.wait(remaining - 10 / 1000)
+                    continue
+            # cpu intensive sleep for less than 10 ms
+            while fire - perf_counter() > 0:
+                sleep(0)
+            with self.cond:
+                if generation != self.generation or deadline != self.deadline():
+                    continue
+                late = perf_counter() - fire
+                if late > self.delay:
+                    # report deadlines we are more than one tick behind instead of slipping the schedule
+                    self.missed += 1
+                    self.max_late = max(self.max_late, late)
+                self.tick += 1
+            if self.next_delay:
+                delay = self.next_delay(deadline)
+                with self.cond:
+                    if generation == self.generation and delay is not None:
+                        # re-anchor at the deadline that fired
+                        self.anchor = deadline
+                        self.tick = 1
+                        self.delay = delay
+            self.action(deadline)
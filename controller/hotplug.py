@@ -0,0 +1,65 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+from select import select
+from _thread import start_new_thread
+from time import sleep
+from devices import Devices
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+class HotplugMonitor():
+    # probes the devices on a background thread whenever a device node in /dev changes
+    # and calls changed() when lightbar or buzzer got plugged in or out,
+    # falls back to polling once a second where inotify is not available
+    def __init__(self, changed, settle=0.02):
+        self.changed = changed
+        # udev creates the node first and sets its permissions afterwards
+        self.settle = settle
+        self.fd = self.watch('/dev')
+        start_new_thread(self.loop, (()))
+
+    @staticmethod
+    def watch(path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, path.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError, TypeError):
+            return None
+
+    def loop(self):
+        state = None
+        force = True
+        while True:
+            try:
+                Devices.probe(force)
+            except Exception as e:
+                print('probe failed: %s' % e, file=sys.stderr)
+            plugged_in = (Devices.lightbar_plugged_in(), Devices.buzzer_plugged_in())
+            if plugged_in != state:
+                state = plugged_in
+                self.changed()
+            force = self.wait()
+
+    def wait(self):
+        # returns True if device nodes changed
+        if self.fd is None:
+            sleep(1)
+            return False
+        ready, _, _ = select([self.fd], [], [], Devices.retry_due_in())
+        if not ready:
+            return False
+        while ready:
+            os.read(self.fd, 4096)
+            ready, _, _ = select([self.fd], [], [], self.settle)
+        return True
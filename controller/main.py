@@ -2,15 +2,24 @@ import pygame
 import thorpy
 from devices import Devices
 from config import Config
-from hiperf_timer import HighPerfTimer
-from time import sleep
+from assets import Assets
+from session import Session
+from hotplug import HotplugMonitor
+from daemon import Daemon
+from commands import Commands
+from control_api import ControlServer
+from session_trace import TraceRecorder
+from time import sleep, perf_counter
+from threading import get_ident
 import os
 from thorpy.painting.painters.imageframe import ButtonImage
 import sys
-from math import log
 
 PROBE_EVENT = pygame.USEREVENT + 1
 ACTION_EVENT = pygame.USEREVENT + 2
+SWEEP_EVENT = pygame.USEREVENT + 3
+CHANGE_EVENT = pygame.USEREVENT + 4
+API_EVENT = pygame.USEREVENT + 5
 
 class MyThorpyApp(thorpy.Application):
     def __init__(self, size, caption=None, icon="thorpy", center=True, flags=0):
@@ -30,6 +39,52 @@ class MyThorpyApp(thorpy.Application):
         _SCREEN = screen
         self.default_path = "./"
 
+class DirtyRects():
+    # screen areas drawn since the last frame, pushed to the display in one update per frame
+    rects = []
+
+    @classmethod
+    def add(cls, rect):
+        cls.rects.append(pygame.Rect(rect))
+
+    @classmethod
+    def flush(cls):
+        if cls.rects:
+            rects, cls.rects = cls.rects, []
+            pygame.display.update(rects)
+
+def solo_update(self):
+    DirtyRects.add(self.get_fus_rect())
+
+# elements do not update the display on their own, the menu flushes the dirty rects
+thorpy.elements.ghost.Ghost.solo_update = solo_update
+
+class Menu(thorpy.Menu):
+    # handles events as soon as they arrive, but draws at most fps frames a second
+    # (calling frame(now) and pushing the dirty rects), the tick events do not wait for the frame
+    def __init__(self, elements, frame=None, fps=30):
+        super().__init__(elements, fps)
+        self.frame = frame
+        self.shown = 0
+
+    def play(self, preblit=True):
+        thorpy.functions.set_current_menu(self)
+        if preblit:
+            self.blit_and_update()
+        while not self.leave:
+            now = perf_counter()
+            wait = self.shown + 1 / self.fps - now
+            if wait <= 0:
+                if self.frame is not None:
+                    self.frame(now)
+                DirtyRects.flush()
+                self.shown = now
+                wait = 1 / self.fps
+            event = pygame.event.wait(max(1, int(wait * 1000)))
+            while event.type != pygame.NOEVENT:
+                self.treatement(event)
+                event = pygame.event.poll()
+
 class Container(thorpy.Ghost):
     def set_visible(self, value):
         for elem in self.get_elements():
@@ -75,7 +130,7 @@ class Selector(Container):
         else:
             str = self.format.format(val)
         self.elem2.set_text(str)
-        self.elem1.unblit_and_reblit()
+        # the title does not change
         self.elem2.unblit_and_reblit()
         if self.updater is not None:
             self.updater()
@@ -153,24 +208,11 @@ class Switch():
 class Controller:
 
     def button(self, x, y, title, callback=None, togglable=False):
-        try:
-            painter = thorpy.painters.imageframe.ButtonImage(
-                img_normal=os.path.join('imgs', '%s_normal.png' % title.lower()),
-                img_pressed=os.path.join('imgs', '%s_pressed.png' % title.lower())
-            )
-        except:
-            painter = thorpy.painters.imageframe.ButtonImage(
-                img_normal=os.path.join('imgs', '%s_normal.png' % 'default'),
-                img_pressed=os.path.join('imgs', '%s_pressed.png' % 'default')
-            )
-        try:
-            inactive_painter = thorpy.painters.imageframe.ButtonImage(
-                img_normal=os.path.join('imgs', '%s_inactive.png' % title.lower())
-            )
-        except:
-            inactive_painter = thorpy.painters.imageframe.ButtonImage(
-                img_normal=os.path.join('imgs', '%s_inactive.png' % 'default')
-            )
+        # equal buttons share their images, missing ones are replaced by the default images
+        def image(state):
+            return Assets.image('%s_%s' % (title.lower(), state)) or Assets.image('default_%s' % state)
+        painter = ButtonImage(img_normal=image('normal'), img_pressed=image('pressed'))
+        inactive_painter = ButtonImage(img_normal=image('inactive'))
         if togglable:
             btn = thorpy.Togglable('')
         else:
@@ -196,10 +238,22 @@ class Controller:
             elem.change_painter(elem.inactive_painter, autopress=False)
             elem.unblit_and_reblit()
 
-    def __init__(self, fullscreen=False, touchscreen=False):
+    def __init__(self, fullscreen=False, touchscreen=False, autonomous=False, hotplug=True, direct=False, api=False):
         self.in_load = False
-        self.pausing = False
-        self.stopping = False
+        # start the control API once the config is loaded
+        self.api = api
+        # the UI observes the session and hands its ticks over to the event loop,
+        # unless they are handled directly on the timing thread
+        self.session = Session(self.post_session, autonomous, direct)
+        self.session.observers.append(self.session_changed)
+        self.ui_thread = get_ident()
+        # session changes from other threads, shown by the next CHANGE_EVENT
+        self.changes = {}
+        self.change_posted = False
+        # counter of a running session, shown by the next frame at most counter rate times a second
+        self.pending_counter = None
+        self.counter_shown = 0
+        self.area = None
         if touchscreen:
             pygame.mouse.set_cursor((8,8),(0,0),(0,0,0,0,0,0,0,0),(0,0,0,0,0,0,0,0))
         self.app = MyThorpyApp(size=(480, 320), caption="EMDR Controller", icon='pygame', flags=pygame.FULLSCREEN if fullscreen else 0)
@@ -218,11 +272,17 @@ class Controller:
         self.btn_speed_plus = self.button(3, 2, '+')
         self.btn_speed_minus = self.button(1, 2, '-')
         self.sel_speed = Selector(2, 2, 'Speed.', Config.speeds, '{0:d}/min', self.btn_speed_plus, self.btn_speed_minus, self.update_speed)
+        self.btn_profile_plus = self.button(3, 3, '+')
+        self.btn_profile_minus = self.button(1, 3, '-')
+        self.sel_profile = Selector(2, 3, 'Motion', Config.profiles, '{0}', self.btn_profile_plus, self.btn_profile_minus, self.update_speed, cyclic=True)
         self.box_speed = Container(elements=[
             self.sel_counter,
             self.btn_speed_plus,
             self.sel_speed,
             self.btn_speed_minus,
+            self.btn_profile_plus,
+            self.sel_profile,
+            self.btn_profile_minus,
         ])
         # lightbar area
         self.btn_light_on = self.button(1, 1, 'On', togglable=True)
@@ -300,14 +360,23 @@ class Controller:
         ])
         self.back.add_reaction(thorpy.Reaction(reacts_to=PROBE_EVENT, reac_func=self.check_usb))
         self.back.add_reaction(thorpy.Reaction(reacts_to=ACTION_EVENT, reac_func=self.action))
-        self.menu = thorpy.Menu(self.back)
-        self.config_mode()
-        self.reset_action()
+        self.back.add_reaction(thorpy.Reaction(reacts_to=SWEEP_EVENT, reac_func=self.sweep))
+        self.back.add_reaction(thorpy.Reaction(reacts_to=CHANGE_EVENT, reac_func=self.show_changes))
+        self.back.add_reaction(thorpy.Reaction(reacts_to=API_EVENT, reac_func=self.api_command))
+        self.menu = Menu(self.back, self.frame, Config.data['ui.fps.config'])
+        self.update_session()
+        self.session.end()
+        self.session.reset()
         self.activate(self.btn_lightbar)
         self.deactivate(self.btn_lightbar)
         self.activate(self.btn_buzzer)
         self.deactivate(self.btn_buzzer)
         self.check_usb(None)
+        Devices.preload_tones([(frequency, duration) for _, frequency, duration in Config.tones],
+                              Config.data.get('headphone.waveform', 'square'))
+        # device detection runs in the background and posts PROBE_EVENT on changes
+        if hotplug:
+            HotplugMonitor(self.post_probe)
 
     def lightbar_click(self):
         if self.btn_lightbar.toggled:
@@ -348,51 +417,74 @@ class Controller:
         sleep(1)
         Devices.do_sound(False)
 
+    def light_color(self):
+        return Session.light_color(self.sel_light_color.get_value(), self.sel_light_intens.get_value())
+
+    def update_session(self):
+        self.session.set_profile(self.sel_profile.get_value())
+        self.session.set_speed(self.sel_speed.get_value())
+        self.session.set_light(self.switch_light.get_value(), self.light_color())
+        self.session.set_buzzer(self.switch_buzzer.get_value())
+        self.session.set_headphone(self.switch_headphone.get_value())
+
     def update_light(self):
-        (color_name, r, g, b) = self.sel_light_color.get_value()
-        intensity = self.sel_light_intens.get_value() / 100 * 0.7 # max. 70 % intensity
-        r = round(r * intensity)
-        g = round(g * intensity)
-        b = round(b * intensity)
-        color = r * 256 * 256 + g * 256 + b
-        Devices.set_color(color)
-        if self.btn_light_test.toggled:
-            Devices.set_led(-1)
-        else:
-            Devices.set_led(Devices.led_num / 2 + 1 if self.switch_light.get_value() else 0)
+        Devices.set_tail(Config.data.get('lightbar.tail', 0))
+        self.session.set_light(self.switch_light.get_value(), self.light_color())
+        if not (self.session.mode == 'action' and self.session.sweeping):
+            Devices.set_color(self.light_color())
+            if self.btn_light_test.toggled:
+                Devices.set_led(-1)
+            else:
+                Devices.set_led(Devices.led_num / 2 + 1 if self.switch_light.get_value() else 0)
         self.save_config()
 
     def update_buzzer(self):
         duration = self.sel_buzzer_duration.get_value()
         Devices.set_buzzer_duration(duration)
+        self.session.set_buzzer(self.switch_buzzer.get_value())
         self.save_config()
 
     def update_sound(self):
         (tone_name, frequency, duration) = self.sel_headphone_tone.get_value()
         volume = self.sel_headphone_volume.get_value() / 100
-        Devices.set_tone(frequency, duration, volume)
+        Devices.set_tone(frequency, duration, volume, Config.data.get('headphone.waveform', 'square'))
+        self.session.set_headphone(self.switch_headphone.get_value())
         self.save_config()
 
     def update_speed(self):
         self.save_config()
-        if self.mode == 'action':
-            self.adjust_action_timer()
+        self.session.set_profile(self.sel_profile.get_value())
+        self.session.set_speed(self.sel_speed.get_value())
 
     def set_area(self, area):
+        # redraw only the boxes shown before and now and the released buttons
+        boxes = {
+            'speed': self.box_speed,
+            'lightbar': self.box_lightbar,
+            'buzzer': self.box_buzzer,
+            'headphone': self.box_headphone,
+        }
+        rects = []
+        if area != self.area and self.area in boxes:
+            rects.append(boxes[self.area].get_family_rect(only_children=True))
         self.box_speed.set_visible(area == 'speed')
         self.box_lightbar.set_visible(area == 'lightbar')
         self.box_buzzer.set_visible(area == 'buzzer')
         self.box_headphone.set_visible(area == 'headphone')
-        if self.btn_lightbar.toggled and area != 'lightbar':
-            self.btn_lightbar._force_unpress()
-        if self.btn_buzzer.toggled and area != 'buzzer':
-            self.btn_buzzer._force_unpress()
-        if self.btn_headphone.toggled and area != 'headphone':
-            self.btn_headphone._force_unpress()
+        if area != self.area:
+            rects.append(boxes[area].get_family_rect(only_children=True))
+        self.area = area
+        for btn, name in ((self.btn_lightbar, 'lightbar'), (self.btn_buzzer, 'buzzer'), (self.btn_headphone, 'headphone')):
+            if btn.toggled and area != name:
+                btn._force_unpress()
+                rects.append(btn.get_fus_rect())
         if area != 'lightbar' and self.btn_light_test.toggled:
             self.btn_light_test._force_unpress()
             self.light_test_click()
-        self.back.unblit_and_reblit()
+        if rects:
+            rect = rects[0].unionall(rects[1:])
+            self.back.partial_blit(None, rect)
+            DirtyRects.add(rect)
 
     def load_config(self):
         try:
@@ -407,6 +499,7 @@ class Controller:
             self.switch_headphone.set_value(Config.data.get('headphone.on'))
             self.sel_headphone_tone.set_value(Config.data.get('headphone.tone'))
             self.sel_headphone_volume.set_value(Config.data.get('headphone.volume'))
+            self.sel_profile.set_value(Config.data.get('general.profile', 'linear'))
         except:
             # do not crash with corrupt config file
             # it will be properly written on close
@@ -416,6 +509,7 @@ class Controller:
     def save_config(self):
         if not self.in_load:
             Config.data['general.speed'] = self.sel_speed.get_value()
+            Config.data['general.profile'] = self.sel_profile.get_value()
             Config.data['lightbar.on'] = self.switch_light.get_value()
             Config.data['lightbar.color'] = self.sel_light_color.get_value()
             Config.data['lightbar.intensity'] = self.sel_light_intens.get_value()
@@ -426,11 +520,52 @@ class Controller:
             Config.data['headphone.volume'] = self.sel_headphone_volume.get_value()
             Config.save()
 
+    def session_changed(self, what, value):
+        if what == 'position':
+            # the lightbar shows it
+            return
+        if get_ident() != self.ui_thread:
+            # called on the timing thread in direct mode, let the event loop show the latest values
+            self.changes[what] = value
+            if not self.change_posted:
+                self.change_posted = True
+                try:
+                    pygame.event.post(pygame.event.Event(CHANGE_EVENT))
+                except:
+                    # catch pygame error in case of overfull event pipe
+                    self.change_posted = False
+            return
+        if what == 'counter':
+            if self.session.mode == 'action':
+                self.pending_counter = value
+            else:
+                self.sel_counter.set_value(value)
+        elif value == 'action':
+            self.action_mode()
+        else:
+            self.config_mode()
+
+    def show_changes(self, event):
+        self.change_posted = False
+        changes, self.changes = self.changes, {}
+        for what in ('counter', 'mode'):
+            if what in changes:
+                self.session_changed(what, changes[what])
+
+    def frame(self, now):
+        if self.pending_counter is not None and now - self.counter_shown >= 1 / Config.data['ui.counter.rate']:
+            self.show_counter(now)
+
+    def show_counter(self, now):
+        self.sel_counter.set_value(self.pending_counter)
+        self.pending_counter = None
+        self.counter_shown = now
+
     def config_mode(self):
-        self.mode = 'config'
-        # no need to disable action timer, since it is a one-shot-timer
-        # enable periodic prob<ing
-        pygame.time.set_timer(PROBE_EVENT, 1000)
+        # the final counter is shown at once
+        if self.pending_counter is not None:
+            self.show_counter(perf_counter())
+        self.menu.fps = Config.data['ui.fps.config']
         # enable/disable buttons
         if not self.btn_pause.toggled:
             self.activate(self.btn_start)
@@ -438,40 +573,13 @@ class Controller:
             self.deactivate(self.btn_stop)
             self.deactivate(self.btn_pause)
 
-    def post_action(self):
-        if self.mode == 'action':
-            timer = HighPerfTimer(self.action_delay + self.action_extra_delay, self.post_action)
-            event = pygame.event.Event(ACTION_EVENT)
-            try:
-                pygame.event.post(event)
-            except:
-                # catch pygame error in case of overfull event pipe
-                pass
-            timer.start()
-
-    def adjust_action_timer(self):
-        # use python threading timer instead of pygame timer due to bad resolution of pygame timer
-        # (typical 10ms)
-        self.action_delay = (60 / self.sel_speed.get_value() / Devices.led_num / 2)
-        self.action_extra_delay = 0
-
     def action_mode(self):
-        if self.mode == 'action':
-            return
-        self.mode = 'action'
-        if not self.pausing:
-            self.sel_counter.set_value(0)
-        self.stopping = False
-        self.pausing = False
-        # disable periodic probing
-        pygame.time.set_timer(PROBE_EVENT, 0)
         # prepare devices
         self.update_light()
         self.update_buzzer()
         self.update_sound()
-        # enable action timer
-        self.adjust_action_timer()
-        HighPerfTimer(self.action_delay, self.post_action).start()
+        # draw less often while the session runs
+        self.menu.fps = Config.data['ui.fps.action']
         # enable/disable buttons
         self.deactivate(self.btn_start)
         self.deactivate(self.btn_start24)
@@ -481,114 +589,170 @@ class Controller:
     def run(self):
         self.load_config()
         self.set_area('speed')
+        if self.api:
+            server = ControlServer(self.post_api, Config.data['api.port'], Config.data['api.socket'], Config.data['api.interval'])
+            self.session.observers.append(server.publish)
+            server.publish('mode', self.session.mode)
+            server.publish('counter', self.session.counter)
         self.menu.play()
         self.save_config()
+        Config.flush()
         #Devices.set_led(0)
         self.app.quit()
 
-    def start_click(self):
+    def start(self, max_counter=0):
+        if self.session.mode == 'action':
+            # Session.start ignores it, keep the pause button as it is
+            return
+        # a new session is never paused, Session.start resets pausing
+        self.unpress_pause()
         self.set_area('speed')
-        self.max_counter = 0
-        self.reset_action()
-        self.action_mode()
+        self.update_session()
+        self.session.start(max_counter)
+
+    def start_click(self):
+        self.start()
 
     def start24_click(self):
-        self.set_area('speed')
-        self.max_counter = 24
-        self.reset_action()
-        self.action_mode()
+        self.start(24)
 
     def stop_click(self):
+        self.unpress_pause()
+        self.session.stop()
+
+    def unpress_pause(self):
         if self.btn_pause.toggled:
             self.btn_pause._force_unpress()
             self.btn_pause.unblit_and_reblit()
-        if self.mode == 'action':
-            self.stopping = True
-        else:
-            self.config_mode()
-            self.reset_action()
 
     def pause_click(self):
         if self.btn_pause.toggled:
-            # pause
-            self.pausing = True
+            self.session.pause()
         else:
-            # resume
-            if self.mode != 'action':
-                self.action_mode()
-            else:
-                self.pausing = False
-                self.action_extra_delay = 0
-                self.decay = False
+            self.update_session()
+            self.session.resume()
+
+    def post_session(self, kind, attrs):
+        event = pygame.event.Event(ACTION_EVENT if kind == 'action' else SWEEP_EVENT, **attrs)
+        try:
+            pygame.event.post(event)
+        except:
+            # catch pygame error in case of overfull event pipe
+            pass
+
+    def post_api(self, line, done):
+        # commands of API clients run on the UI thread like clicks
+        try:
+            pygame.event.post(pygame.event.Event(API_EVENT, line=line, done=done))
+        except:
+            # catch pygame error in case of overfull event pipe
+            done('error busy')
+
+    def api_command(self, event):
+        event.done(self.command(event.line))
+
+    def command(self, line):
+        # runs a command (see Commands) as if the buttons were used, returns the reply
+        try:
+            parsed = Commands.parse(line)
+        except ValueError:
+            return 'error %s' % line.strip()
+        if parsed is None:
+            return None
+        cmd, arg = parsed
+        if cmd == 'start':
+            if self.session.mode != 'action':
+                self.start(arg)
+        elif cmd == 'stop':
+            self.stop_click()
+        elif cmd == 'pause':
+            if self.session.mode == 'action' and not self.btn_pause.toggled:
+                self.btn_pause._press()
+                self.btn_pause.unblit_and_reblit()
+                self.pause_click()
+        elif cmd == 'resume':
+            self.unpress_pause()
+            self.pause_click()
+        elif cmd == 'status':
+            return Commands.status(self.session)
+        elif cmd == 'quit':
+            self.menu.set_leave()
+        elif cmd == 'set':
+            self.apply_setting(*arg)
+        return 'ok'
+
+    def apply_setting(self, key, value):
+        # the updaters apply and save the setting
+        selectors = {
+            'general.speed': self.sel_speed,
+            'general.profile': self.sel_profile,
+            'lightbar.color': self.sel_light_color,
+            'lightbar.intensity': self.sel_light_intens,
+            'buzzer.duration': self.sel_buzzer_duration,
+            'headphone.volume': self.sel_headphone_volume,
+            'headphone.tone': self.sel_headphone_tone,
+        }
+        switches = {
+            'lightbar.on': (self.switch_light, self.update_light),
+            'buzzer.on': (self.switch_buzzer, self.update_buzzer),
+            'headphone.on': (self.switch_headphone, self.update_sound),
+        }
+        if key in selectors:
+            selectors[key].set_value(value)
+        else:
+            switch, update = switches[key]
+            switch.set_value(value)
+            update()
+
+    def post_probe(self):
+        try:
+            pygame.event.post(pygame.event.Event(PROBE_EVENT))
+        except:
+            # catch pygame error in case of overfull event pipe
+            pass
 
     def check_usb(self, event):
-        if self.mode == 'action':
-            return
-        Devices.probe()
         if Devices.buzzer_plugged_in():
             self.activate(self.btn_buzzer)
         else:
             self.deactivate(self.btn_buzzer)
         if Devices.lightbar_plugged_in():
-            if not self.btn_lightbar.active:
+            if not self.btn_lightbar.active and self.session.mode != 'action':
                 Devices.set_led(Devices.led_num / 2 + 1)
             self.activate(self.btn_lightbar)
         else:
             self.deactivate(self.btn_lightbar)
 
-    def reset_action(self):
-        print('reset_action')
-        self.led_pos = int(Devices.led_num / 2) + 1 # start in the middle
-        self.direction = -1
-        self.decay = False
-        Devices.set_led(self.led_pos if self.switch_light.get_value() else 0)
+    def sweep(self, event):
+        self.session.sweep(event.kind, event.counter)
 
     def action(self, event):
-        if self.mode != 'action':
-            return
-        if self.switch_light.get_value():
-            Devices.set_led(self.led_pos)
-        cntr = self.sel_counter.get_value()
-        if self.led_pos == 1:
-            # left end
-            if self.switch_buzzer.get_value():
-                Devices.do_buzzer(True)
-            if self.switch_headphone.get_value():
-                Devices.do_sound(True)
-            if self.direction == -1:
-                self.direction = 1
-        if self.led_pos == Devices.led_num:
-            # right end
-            if self.switch_buzzer.get_value():
-                Devices.do_buzzer(False)
-            if self.switch_headphone.get_value():
-                Devices.do_sound(False)
-            if self.direction == 1:
-                self.direction = -1
-            if cntr == self.max_counter or self.stopping or self.pausing:
-                self.decay = True
-        if self.led_pos == int(Devices.led_num / 2) + 1 and self.direction == -1:
-            # in the middle
-            if self.decay:
-                self.config_mode()
-                self.reset_action()
-                return
-            else:
-                cntr += 1
-            self.sel_counter.set_value(cntr)
-        self.led_pos += self.direction
-        if self.decay:
-            middle = int(Devices.led_num / 2) + 1
-            n = Devices.led_num - middle
-            pos = Devices.led_num - self.led_pos
-            alpha = log(1.2) / (log(n) - log(n - 1))
-            factor = 1.5 / n ** alpha
-            self.action_extra_delay = self.action_delay + factor * pos ** alpha
+        self.session.action(event.scheduled, event.fired)
 
 def main(argv):
     fullscreen = 'fullscreen' in argv
     touchscreen = 'touchscreen' in argv
-    controller = Controller(fullscreen, touchscreen)
+    autonomous = 'autonomous' in argv
+    # write to the devices from the timing thread
+    direct = 'direct' in argv
+    # local control API
+    api = 'api' in argv
+    Devices.binary_protocol = 'binary' in argv
+    if 'trace' in argv:
+        # append all device commands to emdr.trace
+        Devices.tracer = TraceRecorder()
+    # small mixer buffer, the remaining latency is estimated from it and compensated
+    if 'lowlatency' in argv:
+        Devices.init_audio(256)
+    print('audio latency %.1f ms (estimated)' % (Devices.estimate_audio() * 1000), file=sys.stderr)
+    if 'daemon' in argv:
+        # no display, controlled from stdin
+        Daemon(autonomous, direct=direct, api=api).run()
+        return
+    controller = Controller(fullscreen, touchscreen, autonomous, direct=direct, api=api)
+    if 'atlas' in argv:
+        # pack the images into one file, read by the next start
+        Assets.write_atlas()
     controller.run()
 
 if __name__ == '__main__':
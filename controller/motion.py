@@ -0,0 +1,39 @@
+from array import array
+from functools import lru_cache
+from math import log, sin, pi
+
+class Motion():
+    # per step delay tables of a sweep, computed once per (speed, led_num, profile) and cached,
+    # so the timing path only indexes arrays
+    profiles = ('linear', 'ease-in', 'sine')
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def tables(speed, led_num, profile):
+        # returns (sweep, start, decay, cumulative):
+        # sweep[s] = delay between led s and s + 1, the same in both directions,
+        # start[k] = delay of the k-th step from the middle to the left end,
+        # decay[p] = delay before led p is shown while stopping,
+        # cumulative[p] = time from led 1 to led p
+        delay = 60 / speed / led_num / 2
+        middle = int(led_num / 2) + 1
+        sweep = array('d', [delay]) * led_num
+        if profile == 'sine':
+            # fast in the middle, slow at the ends, in the same time per sweep
+            weights = [0] + [1 / (0.3 + 0.7 * sin(pi * (s - 0.5) / (led_num - 1))) for s in range(1, led_num)]
+            scale = delay * (led_num - 1) / sum(weights)
+            sweep = array('d', [w * scale for w in weights])
+        start = array('d', [sweep[s - 1] for s in range(middle, 1, -1)])
+        if profile == 'ease-in':
+            # speed up from a third of the speed on the way to the left end
+            n = len(start)
+            start = array('d', [d * (1 + 2 * (1 - k / n) ** 2) for k, d in enumerate(start)])
+        # logarithmic slow down towards the middle
+        n = led_num - middle
+        alpha = log(1.2) / (log(n) - log(n - 1))
+        factor = 1.5 / n ** alpha
+        decay = array('d', [2 * delay + factor * (led_num - p) ** alpha for p in range(led_num + 1)])
+        cumulative = array('d', [0]) * (led_num + 1)
+        for p in range(2, led_num + 1):
+            cumulative[p] = cumulative[p - 1] + sweep[p - 1]
+        return sweep, start, decay, cumulative
@@ -0,0 +1,335 @@
+import sys
+from threading import RLock
+from time import perf_counter
+from devices import Devices
+from hiperf_timer import SessionScheduler
+from motion import Motion
+from timing import TickRecorder
+
+class Session():
+    # the sweep of a session (led position, direction, counter, decay and end detection)
+    # without any UI, ticks of the scheduler and reports of an autonomous lightbar are
+    # handed to post(kind, attrs), which has to call action(**attrs) or sweep(**attrs)
+    # on the thread that controls the session, or in direct mode calls them right on the
+    # timing thread, observers are called with ('mode', 'action'/'config'), ('counter', value)
+    # and ('position', led) for every step of a timed session
+    def __init__(self, post, autonomous=False, direct=False):
+        self.post = post
+        # device writes do not wait for the thread of the host
+        self.direct = direct
+        # the timing thread and the host both drive the session in direct mode
+        self.lock = RLock()
+        self.observers = []
+        self.mode = None
+        # let a capable lightbar run the sweep on its own
+        self.autonomous = autonomous
+        self.sweeping = False
+        self.speed = 10
+        self.profile = 'linear'
+        self.light = True
+        self.color = 0
+        self.buzzer = True
+        self.headphone = True
+        self.counter = 0
+        self.max_counter = 0
+        self.pausing = False
+        self.stopping = False
+        self.action_delay = 0
+        # delay before the next tick
+        self.delay = 0
+        # (led_pos, direction, steps, counter) of the next tick, stepped on the timing thread
+        # when a tick fires, the handler of the tick catches up with it
+        self.cursor = None
+        self.motion = Motion.tables(self.speed, Devices.led_num, self.profile)
+        self.scheduler = SessionScheduler(self.post_action, next_delay=self.next_delay)
+        self.recorder = TickRecorder()
+        Devices.write_listener = self.recorder.written_at
+        self.reset()
+
+    @staticmethod
+    def light_color(color, intensity):
+        # color = (name, r, g, b), intensity in percent
+        (color_name, r, g, b) = color
+        intensity = intensity / 100 * 0.7 # max. 70 % intensity
+        r = round(r * intensity)
+        g = round(g * intensity)
+        b = round(b * intensity)
+        return r * 256 * 256 + g * 256 + b
+
+    def notify(self, what, value):
+        for observer in self.observers:
+            observer(what, value)
+
+    def set_counter(self, counter):
+        self.counter = counter
+        self.notify('counter', counter)
+
+    def set_speed(self, speed):
+        with self.lock:
+            self.speed = speed
+            if self.mode == 'action':
+                if self.sweeping:
+                    Devices.set_sweep_speed(speed)
+                else:
+                    self.adjust_action_timer()
+                    self.sync_sound()
+
+    def set_profile(self, profile):
+        # applies with the next set_speed
+        self.profile = profile
+
+    def set_light(self, on, color):
+        self.light = on
+        self.color = color
+        if self.mode == 'action' and self.sweeping:
+            # the lightbar sweeps on its own, setting a led would stop it, so just sweep dark
+            Devices.set_color(color if on else 0)
+
+    def set_buzzer(self, on):
+        self.buzzer = on
+
+    def set_headphone(self, on):
+        with self.lock:
+            self.headphone = on
+            self.sync_sound()
+
+    def start(self, max_counter=0):
+        with self.lock:
+            if self.mode == 'action':
+                # already running, a second start must not reset it
+                return
+            self.max_counter = max_counter
+            # a fresh session, even if the last one ended while paused or stopping
+            self.pausing = False
+            self.stopping = False
+            self.reset()
+            self.begin()
+
+    def stop(self):
+        with self.lock:
+            if self.mode == 'action':
+                self.stopping = True
+                if self.sweeping:
+                    Devices.halt_sweep()
+            else:
+                self.end()
+                self.reset()
+
+    def pause(self):
+        with self.lock:
+            self.pausing = True
+            if self.mode == 'action' and self.sweeping:
+                Devices.halt_sweep()
+
+    def resume(self):
+        with self.lock:
+            if not self.pausing:
+                # nothing paused, a running session (or a stopping one) goes on as it is
+                return
+            if self.mode != 'action':
+                self.begin()
+            elif self.sweeping:
+                self.pausing = False
+                self.start_sweep()
+            else:
+                self.pausing = False
+                self.decay = False
+                self.scheduler.set_delay(self.step_delay(*self.cursor[:3]))
+                self.sync_sound()
+
+    def begin(self):
+        if self.mode == 'action':
+            return
+        self.mode = 'action'
+        if not self.pausing:
+            self.set_counter(0)
+        self.stopping = False
+        self.pausing = False
+        self.recorder.clear()
+        Devices.reset_stats()
+        # longer sessions than the firmware can count are stepped by the host
+        self.sweeping = (self.autonomous and Devices.lightbar_autonomous()
+                         and self.max_counter - self.counter <= Devices.max_sweep_count)
+        # let the observers prepare the devices
+        self.notify('mode', 'action')
+        if self.sweeping:
+            # firmware counts from zero for every sweep
+            self.sweep_base = self.counter
+            self.start_sweep()
+        else:
+            # enable action timer, early for devices executing the steps on their clock
+            # (if their samples are fresh, see next_delay)
+            Devices.set_clock_sync(True)
+            self.scheduler.lead = Devices.schedule_lead()
+            self.cursor = (self.led_pos, self.direction, self.steps, self.counter)
+            self.adjust_action_timer()
+            self.delay = self.action_delay
+            self.scheduler.start(self.delay)
+            self.sync_sound()
+
+    def end(self):
+        with self.lock:
+            if self.mode == 'action':
+                self.scheduler.stop()
+                if self.scheduler.missed:
+                    print('missed %d deadlines, max. %.1f ms late' % (self.scheduler.missed, self.scheduler.max_late * 1000),
+                          file=sys.stderr)
+                self.recorder.dump()
+                print('devices', Devices.stats(), file=sys.stderr)
+                if self.sweeping:
+                    Devices.stop_sweep()
+                Devices.stop_sound()
+                Devices.set_clock_sync(False)
+            self.mode = 'config'
+            self.notify('mode', 'config')
+
+    def reset(self):
+        with self.lock:
+            print('reset_action', file=sys.stderr)
+            self.led_pos = int(Devices.led_num / 2) + 1 # start in the middle
+            self.direction = -1
+            self.decay = False
+            # step of the right end the decay was decided at
+            self.decay_step = 0
+            # steps since the start
+            self.steps = 0
+            Devices.set_led(self.led_pos if self.light else 0)
+
+    def post_action(self, deadline):
+        if self.direct:
+            self.action(deadline, perf_counter())
+        elif self.mode == 'action':
+            self.post('action', dict(scheduled=deadline, fired=perf_counter()))
+
+    def adjust_action_timer(self):
+        # use our own scheduler thread instead of pygame timer due to bad resolution of pygame timer
+        # (typical 10ms), the tables of the new speed replace the old ones at once
+        self.action_delay = (60 / self.speed / Devices.led_num / 2)
+        self.motion = Motion.tables(self.speed, Devices.led_num, self.profile)
+        if self.mode == 'action':
+            self.scheduler.set_delay(self.step_delay(*self.cursor[:3]))
+
+    def step_delay(self, led_pos, direction, steps):
+        # delay before the tick showing led_pos
+        sweep, start, decay, cumulative = self.motion
+        if self.decay:
+            return decay[led_pos]
+        if 0 < steps <= len(start):
+            return start[steps - 1]
+        if steps == 0:
+            return self.action_delay
+        return sweep[min(led_pos, led_pos - direction)]
+
+    def next_delay(self, deadline):
+        # on the timing thread when the tick of deadline fires: step the cursor over it like
+        # action() steps the session, decide the decay, and return the delay before the next tick
+        with self.lock:
+            if self.mode != 'action':
+                return None
+            led_pos, direction, steps, counter = self.cursor
+            if led_pos == 1:
+                direction = 1
+            if led_pos == Devices.led_num:
+                direction = -1
+                if counter == self.max_counter or self.stopping or self.pausing:
+                    self.decay = True
+                    self.decay_step = steps
+            if led_pos == int(Devices.led_num / 2) + 1 and direction == -1:
+                if self.decay:
+                    # the handler of this tick ends the session
+                    return None
+                counter += 1
+                # devices syncing again after an idle time get their lead from the next sweep on
+                self.scheduler.lead = Devices.schedule_lead()
+            led_pos += direction
+            steps += 1
+            self.cursor = (led_pos, direction, steps, counter)
+            return self.step_delay(led_pos, direction, steps)
+
+    def sync_sound(self):
+        # the beeps of a timed session are streamed, in phase with the next action tick
+        if (self.mode == 'action' and not self.sweeping and not self.decay and self.scheduler.running
+                and self.headphone):
+            sweep, start, decay, cumulative = self.motion
+            led_pos, direction, steps, counter = self.cursor
+            if steps < len(start):
+                # still on the way from the middle to the left end
+                elapsed = -sum(start[steps:])
+            else:
+                elapsed = cumulative[led_pos] * direction
+            Devices.sync_sound(elapsed, self.scheduler.deadline(), cumulative[Devices.led_num])
+        else:
+            Devices.stop_sound()
+
+    def start_sweep(self):
+        count = self.max_counter - self.sweep_base if self.max_counter else 0
+        Devices.start_sweep(self.speed, self.color if self.light else 0, max(count, 0), self.post_sweep)
+
+    def post_sweep(self, kind, counter):
+        if self.direct:
+            self.sweep(kind, counter)
+        else:
+            self.post('sweep', dict(kind=kind, counter=counter))
+
+    def sweep(self, kind, counter):
+        # events reported by the autonomously sweeping lightbar
+        with self.lock:
+            if self.mode != 'action':
+                return
+            if kind == 'left':
+                if self.buzzer:
+                    Devices.do_buzzer(True)
+                if self.headphone:
+                    Devices.do_sound(True)
+            elif kind == 'right':
+                if self.buzzer:
+                    Devices.do_buzzer(False)
+                if self.headphone:
+                    Devices.do_sound(False)
+            elif kind == 'middle':
+                self.set_counter(self.sweep_base + counter)
+            elif kind == 'end':
+                self.end()
+                self.reset()
+
+    def action(self, scheduled, fired):
+        with self.lock:
+            if self.mode != 'action':
+                return
+            handled = perf_counter()
+            tick = self.recorder.record(scheduled, fired, handled, self.delay, self.speed)
+            if self.light and Devices.lightbar_plugged_in():
+                Devices.set_led(self.led_pos, tick, scheduled)
+            else:
+                # nothing to write, the tick is not dropped
+                self.recorder.written_at(tick, handled)
+            self.notify('position', self.led_pos)
+            cntr = self.counter
+            if self.led_pos == 1:
+                # left end
+                if self.buzzer:
+                    Devices.do_buzzer(True, scheduled)
+                if self.direction == -1:
+                    self.direction = 1
+            if self.led_pos == Devices.led_num:
+                # right end
+                if self.buzzer:
+                    Devices.do_buzzer(False, scheduled)
+                if self.direction == 1:
+                    self.direction = -1
+                if self.decay and self.steps == self.decay_step:
+                    # decided by next_delay when this tick fired, no more beeps after this one
+                    Devices.stop_sound(scheduled)
+            if self.led_pos == int(Devices.led_num / 2) + 1 and self.direction == -1:
+                # in the middle
+                if self.decay and self.steps > self.decay_step:
+                    self.end()
+                    self.reset()
+                    return
+                else:
+                    cntr += 1
+                self.set_counter(cntr)
+            self.led_pos += self.direction
+            self.steps += 1
+            # the scheduler took this delay from next_delay already, it is recorded with the next tick
+            self.delay = self.step_delay(self.led_pos, self.direction, self.steps)
@@ -0,0 +1,207 @@
+import os
+# replays run without display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import argparse
+import atexit
+import json
+import struct
+import sys
+from threading import Condition, Lock
+from _thread import start_new_thread
+from time import perf_counter, sleep
+from timing import TickRecorder
+
+MAGIC = b'EMDRTRC1'
+# perf_counter time, op, flag, small, a, b, c
+RECORD = struct.Struct('<dBBHiii')
+# stop_sound() without time
+NOW = -0x80000000
+LED, COLOR, BUZZER, SOUND, TONE, SYNC_SOUND, STOP_SOUND = range(1, 8)
+OPS = {LED: 'set_led', COLOR: 'set_color', BUZZER: 'do_buzzer', SOUND: 'do_sound', TONE: 'set_tone',
+       SYNC_SOUND: 'sync_sound', STOP_SOUND: 'stop_sound'}
+WAVEFORMS = ('square', 'bandlimited', 'sine')
+# flag of any other waveform, which the tone bank renders as a square wave
+OTHER_WAVEFORM = 0xff
+
+class TraceRecorder():
+    # the device commands of Devices with their time, packed into a preallocated ring buffer
+    # (no allocation in the timing path) and appended to the file by a background thread,
+    # times relative to the command are stored in microseconds
+    def __init__(self, filename='emdr.trace', capacity=4096, interval=0.5):
+        self.filename = filename
+        self.capacity = capacity
+        self.interval = interval
+        self.ring = bytearray(RECORD.size * capacity)
+        # records packed and written since the start
+        self.head = 0
+        self.tail = 0
+        # records lost because the ring was full
+        self.dropped = 0
+        self.cond = Condition()
+        self.writing = Lock()
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            with open(filename, 'wb') as f:
+                f.write(MAGIC)
+        atexit.register(self.flush)
+        start_new_thread(self.loop, (()))
+
+    def record(self, op, flag=0, small=0, a=0, b=0, c=0):
+        with self.cond:
+            if self.head - self.tail >= self.capacity:
+                self.dropped += 1
+                return
+            RECORD.pack_into(self.ring, self.head % self.capacity * RECORD.size,
+                             perf_counter(), op, flag, small, a, b, c)
+            self.head += 1
+            if self.head - self.tail == self.capacity // 2:
+                self.cond.notify()
+
+    def set_led(self, num):
+        self.record(LED, a=int(num))
+
+    def set_color(self, col):
+        self.record(COLOR, a=col)
+
+    def do_buzzer(self, left, duration):
+        self.record(BUZZER, flag=left, small=duration)
+
+    def do_sound(self, left):
+        self.record(SOUND, flag=left)
+
+    def set_tone(self, frequency, duration, volume, waveform):
+        flag = WAVEFORMS.index(waveform) if waveform in WAVEFORMS else OTHER_WAVEFORM
+        self.record(TONE, flag=flag, a=frequency, b=duration, c=int(round(volume * 1000)))
+
+    def sync_sound(self, elapsed, at, half):
+        self.record(SYNC_SOUND, a=int(elapsed * 1e6), b=int((at - perf_counter()) * 1e6), c=int(half * 1e6))
+
+    def stop_sound(self, at):
+        self.record(STOP_SOUND, a=NOW if at is None else int((at - perf_counter()) * 1e6))
+
+    def loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.writing:
+            with self.cond:
+                head, tail = self.head, self.tail
+            if head == tail:
+                return
+            # records between tail and head are not touched until tail moves on
+            ring = memoryview(self.ring)
+            first, last = tail % self.capacity, head % self.capacity
+            with open(self.filename, 'ab') as f:
+                if first < last:
+                    f.write(ring[first * RECORD.size:last * RECORD.size])
+                else:
+                    f.write(ring[first * RECORD.size:])
+                    f.write(ring[:last * RECORD.size])
+            with self.cond:
+                self.tail = head
+
+def read(filename):
+    # list of (time, op, flag, small, a, b, c)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is no trace' % filename)
+    n = (len(data) - len(MAGIC)) // RECORD.size
+    return list(RECORD.iter_unpack(data[len(MAGIC):len(MAGIC) + n * RECORD.size]))
+
+def stats(records):
+    # count and intervals (ms) between the commands of each kind, gaps of more than a second
+    # (between sessions) are left out
+    times = {}
+    for record in records:
+        times.setdefault(OPS.get(record[1], str(record[1])), []).append(record[0])
+    result = {}
+    for name, t in sorted(times.items()):
+        intervals = sorted((b - a) * 1000 for a, b in zip(t, t[1:]) if b - a < 1)
+        result[name] = {
+            'count': len(t),
+            'p50': TickRecorder.percentile(intervals, 50),
+            'p95': TickRecorder.percentile(intervals, 95),
+            'p99': TickRecorder.percentile(intervals, 99),
+            'max': intervals[-1] if intervals else 0,
+        }
+    return result
+
+def replay(records, speedup=1):
+    # re-issues the commands to Devices at their original pace (divided by speedup),
+    # returns how late they were issued in ms
+    from devices import Devices
+    if not records:
+        return []
+    t0 = records[0][0]
+    start = perf_counter() + 0.1
+    late = []
+    for time, op, flag, small, a, b, c in records:
+        due = start + (time - t0) / speedup
+        # cpu friendly wait for more than 2 ms, then spin
+        remaining = due - perf_counter()
+        if remaining > 0.002:
+            sleep(remaining - 0.002)
+        while due - perf_counter() > 0:
+            sleep(0)
+        late.append((perf_counter() - due) * 1000)
+        if op == LED:
+            Devices.set_led(a)
+        elif op == COLOR:
+            Devices.set_color(a)
+        elif op == BUZZER:
+            Devices.set_buzzer_duration(small)
+            Devices.do_buzzer(bool(flag))
+        elif op == SOUND:
+            Devices.do_sound(bool(flag))
+        elif op == TONE:
+            Devices.set_tone(a, b, c / 1000, WAVEFORMS[flag] if flag < len(WAVEFORMS) else 'square')
+        elif op == SYNC_SOUND:
+            Devices.sync_sound(a / 1e6 / speedup, due + b / 1e6 / speedup, c / 1e6 / speedup)
+        elif op == STOP_SOUND:
+            Devices.stop_sound(None if a == NOW else due + a / 1e6 / speedup)
+    return late
+
+def main_trace(argv):
+    parser = argparse.ArgumentParser(description='show, compare or replay recorded device commands')
+    sub = parser.add_subparsers(dest='action', required=True)
+    p = sub.add_parser('stats', help='command intervals of one trace, or of two traces and their difference')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('replay', help='issue the commands of a trace to the devices again')
+    p.add_argument('file')
+    p.add_argument('--speedup', type=float, default=1, help='replay this many times faster')
+    p.add_argument('--fake', metavar='BOARD', help='replay to emulated boards of this type instead of real ones')
+    p.add_argument('--record', metavar='FILE', help='record the replayed commands to this trace')
+    args = parser.parse_args(argv)
+    if args.action == 'stats':
+        result = {f: stats(read(f)) for f in args.files}
+        if len(args.files) == 2:
+            a, b = (result[f] for f in args.files)
+            result['difference'] = {op: {k: b[op][k] - a[op][k] for k in a[op]} for op in a if op in b}
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    records = read(args.file)
+    from devices import Devices
+    if args.fake:
+        from benchmark import attach
+        attach(args.fake)
+    else:
+        Devices.probe(True)
+    if args.record:
+        Devices.tracer = TraceRecorder(args.record)
+    late = sorted(replay(records, args.speedup))
+    sleep(0.2)
+    json.dump({
+        'records': len(records),
+        'late_ms': {'p50': TickRecorder.percentile(late, 50), 'p99': TickRecorder.percentile(late, 99),
+                    'max': late[-1] if late else 0},
+        'devices': Devices.stats(),
+    }, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main_trace(sys.argv[1:])
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+
+class SkewStats():
+    # how far the devices of one role are apart on the host side: every step broadcast to them is
+    # written by each device's own writer thread, once all of them wrote it the spread of the write
+    # completion times is its skew, what the devices show may be further apart (USB, firmware)
+    def __init__(self, tolerance=0.002, window=64):
+        self.tolerance = tolerance
+        # steps waiting for the remaining devices, older ones were dropped or coalesced on a device
+        self.window = window
+        self.lock = Lock()
+        self.steps = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.steps.clear()
+            self.count = 0
+            self.incomplete = 0
+            self.over = 0
+            self.sum_skew = 0
+            self.max_skew = 0
+            # device -> [steps, sum, max] of the time it wrote after the first device
+            self.lag = {}
+
+    def written(self, device, step, devices, time):
+        # called from the writer threads, devices = number of devices the step was sent to
+        with self.lock:
+            times = self.steps.setdefault(step, {})
+            times[device] = time
+            if len(times) < devices:
+                if len(self.steps) > self.window:
+                    self.steps.popitem(last=False)
+                    self.incomplete += 1
+                return
+            del self.steps[step]
+            first = min(times.values())
+            skew = max(times.values()) - first
+            self.count += 1
+            self.sum_skew += skew
+            self.max_skew = max(self.max_skew, skew)
+            if skew > self.tolerance:
+                self.over += 1
+            for device, time in times.items():
+                lag = self.lag.setdefault(device, [0, 0, 0])
+                lag[0] += 1
+                lag[1] += time - first
+                lag[2] = max(lag[2], time - first)
+
+    def stats(self):
+        # host-side write skew in seconds
+        with self.lock:
+            return {
+                'steps': self.count,
+                'incomplete': self.incomplete,
+                'tolerance': self.tolerance,
+                'over_tolerance': self.over,
+                'avg_skew': self.sum_skew / self.count if self.count else 0,
+                'max_skew': self.max_skew,
+                'lag': {device: {'avg': s / n, 'max': m} for device, (n, s, m) in self.lag.items()},
+            }
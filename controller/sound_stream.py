@@ -0,0 +1,145 @@
+from array import array
+from collections import deque
+from threading import Condition
+from _thread import start_new_thread
+from time import perf_counter, sleep
+import pygame
+
+class SoundStream():
+    # plays the beeps of a session as one continuous stereo stream on a single channel:
+    # a full sweep cycle (left beep at the left end, right beep half a cycle later) is rendered
+    # once per speed or tone, and a feeder thread queues short slices of it, read at the phase
+    # the sweep will have when the slice is heard, so beeps are sample accurate and in phase
+    def __init__(self, channel, slice=0.05, poll=0.005):
+        self.channel = channel
+        self.slice = slice
+        self.poll = poll
+        self.beep = None
+        self.volume = 1
+        self.latency = 0
+        self.cycle = None
+        # seconds from one end to the other
+        self.half = None
+        self.rendered = None
+        # time at which the sweep is at phase (seconds after the left end)
+        self.at = 0
+        self.phase = 0
+        self.stop_at = None
+        self.running = False
+        self.cond = Condition()
+        start_new_thread(self.loop, (()))
+
+    def set_channel(self, channel):
+        with self.cond:
+            self.running = False
+            self.channel = channel
+
+    def set_beep(self, beep, volume):
+        with self.cond:
+            self.beep = beep
+            self.volume = beep.get_volume() * volume
+            self.rendered = None
+
+    def sync(self, elapsed, at, half, latency):
+        # at time at, elapsed seconds have passed since the left end (negative: to go until it)
+        with self.cond:
+            if half != self.half:
+                self.rendered = None
+            self.half = half
+            self.latency = latency
+            self.at = at
+            self.phase = elapsed
+            self.stop_at = None
+            self.running = True
+            self.cond.notify()
+
+    def stop(self, at=None):
+        # at = time of the last end, its beep is played to the end
+        with self.cond:
+            if at is None:
+                self.running = False
+                self.channel.stop()
+            elif self.running:
+                self.stop_at = at + (self.beep.get_length() if self.beep else 0)
+
+    def render(self):
+        # one full cycle of interleaved stereo frames
+        rate, _, channels = pygame.mixer.get_init()
+        half = int(round(self.half * rate))
+        cycle = array('h', [0]) * (2 * half * channels)
+        beep = array('h', self.beep.get_raw()) if self.beep else array('h')
+        n = min(len(beep) // channels, half)
+        # left beep on the first, right beep on the last channel
+        cycle[0:n * channels:channels] = beep[0:n * channels:channels]
+        right = half * channels + channels - 1
+        cycle[right:right + n * channels:channels] = beep[channels - 1:n * channels:channels]
+        self.cycle = cycle
+        self.rendered = (rate, channels)
+
+    def feed(self, heard, start=False):
+        # plays (start) or queues the slice heard from time heard on,
+        # returns its length, None once the stream is stopped
+        with self.cond:
+            if not self.running or self.half is None:
+                return None
+            if self.stop_at is not None and heard >= self.stop_at:
+                self.running = False
+                return None
+            if self.rendered is None:
+                self.render()
+            rate, channels = self.rendered
+            frames = len(self.cycle) // channels
+            n = int(self.slice * rate)
+            first = int(round((self.phase + heard - self.at) * rate)) % frames
+            last = first + n
+            if last <= frames:
+                buf = self.cycle[first * channels:last * channels]
+            else:
+                buf = self.cycle[first * channels:] + self.cycle[:(last - frames) * channels]
+            sound = pygame.mixer.Sound(buffer=buf)
+            sound.set_volume(self.volume)
+            # under the lock, so a concurrent stop() cannot be undone
+            if start:
+                self.channel.play(sound)
+            else:
+                self.channel.queue(sound)
+            return n / rate
+
+    def loop(self):
+        # stream time: the slice started at t0 + offset is heard latency later
+        t0 = 0
+        offset = 0
+        # lateness of slice starts, the minimum over a window tracks the audio clock drift
+        lateness = deque(maxlen=8)
+        baseline = None
+        queued = None
+        while True:
+            with self.cond:
+                while not self.running:
+                    queued = None
+                    self.cond.wait()
+                channel = self.channel
+            if not channel.get_busy():
+                # start, or restart after an underrun
+                t0 = perf_counter()
+                lateness.clear()
+                baseline = None
+                queued = None
+                offset = self.feed(t0 + self.latency, True) or 0
+            elif channel.get_queue() is None:
+                now = perf_counter()
+                if queued is not None:
+                    # the queued slice has just started
+                    lateness.append(now - t0 - queued)
+                    if len(lateness) == lateness.maxlen:
+                        late = min(lateness)
+                        if baseline is None:
+                            baseline = late
+                        elif abs(late - baseline) > 0.002:
+                            # the audio clock drifted, read the cycle from the drifted phase
+                            t0 += late - baseline
+                            lateness.clear()
+                length = self.feed(t0 + offset + self.latency)
+                queued = offset if length else None
+                offset += length or 0
+            sleep(self.poll)
@@ -0,0 +1,80 @@
+import unittest
+from clock_sync import ClockSync
+
+class Device():
+    # a device clock offset us ahead of the host and drift ppm fast, sampled in the middle
+    # of a round trip of rtt seconds
+    def __init__(self, clock, offset=0, drift=0, rtt=0.002):
+        self.clock = clock
+        self.offset = offset
+        self.drift = drift
+        self.rtt = rtt
+
+    def us(self, host):
+        return self.offset + host * 1e6 * (1 + self.drift / 1e6)
+
+    def sync(self, host):
+        seq = self.clock.next_seq()
+        self.clock.sent_at(seq, host)
+        self.clock.received(seq, int(self.us(host + self.rtt / 2)) % ClockSync.wrap, host + self.rtt)
+
+    def error_us(self, host):
+        # how far to_device is off, across the wrap
+        wrap = ClockSync.wrap
+        return (self.clock.to_device(host) - int(self.us(host)) + wrap / 2) % wrap - wrap / 2
+
+class TestClockSync(unittest.TestCase):
+    def test_wrap(self):
+        # the 24 bit ticks wrap every 16.8 s, samples across two wraps stay on one line
+        device = Device(ClockSync(), offset=ClockSync.wrap - 3e6)
+        for i in range(20):
+            device.sync(i * 2)
+        self.assertTrue(device.clock.synced())
+        times = [s[1] for s in device.clock.samples]
+        self.assertEqual(times, sorted(times))
+        self.assertGreater(times[-1] - times[0], ClockSync.wrap)
+        self.assertLess(abs(device.error_us(40.5)), 100)
+
+    def test_drift(self):
+        device = Device(ClockSync(), drift=40)
+        for i in range(16):
+            device.sync(i * 2)
+        self.assertAlmostEqual(device.clock.stats()['drift_ppm'], 40, delta=2)
+        # a session later the offset is still within the round trip
+        self.assertLess(abs(device.error_us(60)), 1000)
+
+    def test_drift_limit(self):
+        # a rate further off than a crystal can be is not believed
+        device = Device(ClockSync(), drift=5000)
+        for i in range(16):
+            device.sync(i * 2)
+        self.assertEqual(device.clock.stats()['drift_ppm'], 0)
+
+    def test_stale_samples(self):
+        # a burst after connecting is too short to see the drift, after 10 idle minutes
+        # at 40 ppm the offset is 24 ms off
+        clock = ClockSync()
+        device = Device(clock, drift=40)
+        for i in range(10):
+            device.sync(i * clock.fast_interval)
+        self.assertTrue(clock.synced())
+        self.assertGreater(abs(device.error_us(600)), 20000)
+        clock.resume(600)
+        self.assertFalse(clock.synced())
+        for i in range(clock.needed):
+            device.sync(600 + i * clock.fast_interval)
+        self.assertTrue(clock.synced())
+        self.assertLess(abs(device.error_us(600.5)), 1000)
+
+    def test_resume_keeps_fresh_samples(self):
+        clock = ClockSync()
+        device = Device(clock)
+        for i in range(8):
+            device.sync(i * clock.interval)
+        # the last stale intervals are fresh
+        clock.resume(7 * clock.interval + 1)
+        self.assertTrue(clock.synced())
+        self.assertEqual(len(clock.samples), clock.stale)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from array import array
+from math import isnan
+from time import strftime
+
+class TickRecorder():
+    # fixed size ring buffer of per tick timestamps (perf_counter seconds),
+    # preallocated so recording does not allocate in the timing path
+    def __init__(self, capacity=8192, filename='emdr.timing'):
+        self.capacity = capacity
+        self.filename = filename
+        self.scheduled = array('d', [0]) * capacity
+        self.fired = array('d', [0]) * capacity
+        self.handled = array('d', [0]) * capacity
+        self.written = array('d', [0]) * capacity
+        self.period = array('d', [0]) * capacity
+        self.speed = array('H', [0]) * capacity
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+
+    def record(self, scheduled, fired, handled, period, speed):
+        # returns the slot to report the write time to, unwritten (dropped) ticks stay nan
+        i = self.count % self.capacity
+        self.scheduled[i] = scheduled
+        self.fired[i] = fired
+        self.handled[i] = handled
+        self.written[i] = float('nan')
+        self.period[i] = period
+        self.speed[i] = speed
+        self.count += 1
+        return i
+
+    def written_at(self, i, written):
+        self.written[i] = written
+
+    def ticks(self):
+        first = max(0, self.count - self.capacity)
+        return [i % self.capacity for i in range(first, self.count)]
+
+    @staticmethod
+    def percentile(values, p):
+        # nearest rank on a sorted list
+        if not values:
+            return 0
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    def report(self):
+        # jitter in ms per speed for each stage, measured against the scheduled tick time
+        stages = {'timer': self.fired, 'queue': self.handled, 'write': self.written}
+        by_speed = {}
+        for i in self.ticks():
+            by_speed.setdefault(self.speed[i], []).append(i)
+        result = {}
+        for speed, idx in sorted(by_speed.items()):
+            entry = {'ticks': len(idx)}
+            written = [i for i in idx if not isnan(self.written[i])]
+            entry['dropped'] = len(idx) - len(written)
+            for stage, times in stages.items():
+                jitter = sorted((times[i] - self.scheduled[i]) * 1000 for i in (written if stage == 'write' else idx))
+                if not jitter:
+                    continue
+                entry[stage] = {
+                    'p50': self.percentile(jitter, 50),
+                    'p95': self.percentile(jitter, 95),
+                    'p99': self.percentile(jitter, 99),
+                    'max': jitter[-1],
+                }
+            # the step was not on the device before the next one was due
+            entry['overruns'] = sum(1 for i in written if self.written[i] - self.scheduled[i] > self.period[i])
+            result[speed] = entry
+        return result
+
+    def dump(self):
+        report = self.report()
+        if not report or not self.filename:
+            return
+        with open(self.filename, 'a') as f:
+            f.write('session %s\n' % strftime('%Y-%m-%d %H:%M:%S'))
+            for speed, entry in report.items():
+                f.write('  %3d/min %6d ticks %4d overruns %4d dropped\n' % (speed, entry['ticks'], entry['overruns'], entry['dropped']))
+                for stage in ('timer', 'queue', 'write'):
+                    if stage not in entry:
+                        continue
+                    f.write('    %-5s p50 %7.3f  p95 %7.3f  p99 %7.3f  max %7.3f ms\n' % (
+                        stage, entry[stage]['p50'], entry[stage]['p95'], entry[stage]['p99'], entry[stage]['max']))
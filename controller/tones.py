@@ -0,0 +1,65 @@
+from array import array
+from collections import OrderedDict
+from math import sin, pi
+import pygame
+
+class ToneBank():
+    # renders complete beeps (with short fades against clicks) once and keeps the recently used ones,
+    # so switching tones is a lookup instead of a synthesis
+    waveforms = ('square', 'bandlimited', 'sine')
+
+    def __init__(self, size=16, fade=0.002, volume=.33):
+        self.size = size
+        self.fade = fade
+        self.volume = volume
+        self.cache = OrderedDict()
+
+    def get(self, frequency, duration, waveform='square'):
+        rate, bits, channels = pygame.mixer.get_init()
+        key = (frequency, duration, rate, waveform)
+        sound = self.cache.get(key)
+        if sound is None:
+            sound = pygame.mixer.Sound(buffer=self.render(frequency, duration, rate, bits, channels, waveform))
+            sound.set_volume(self.volume)
+            self.cache[key] = sound
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return sound
+
+    def clear(self):
+        # sounds belong to the mixer they were made for
+        self.cache.clear()
+
+    def render(self, frequency, duration, rate, bits, channels, waveform):
+        # the former notes were a mono period played on the stereo mixer (an octave higher)
+        # and looped duration times, render exactly that sound
+        pitch = frequency * channels
+        period = max(2, int(round(rate / pitch)))
+        amplitude = 2 ** (abs(bits) - 1) - 1
+        wave = self.period(period, amplitude, rate, waveform)
+        # one period of interleaved frames, repeated in bulk
+        frames = array('h', [s for s in wave for _ in range(channels)]) * (duration + 1)
+        n = min(int(rate * self.fade), len(frames) // channels // 2)
+        for i in range(n):
+            level = i / n
+            head = i * channels
+            tail = len(frames) - (i + 1) * channels
+            for c in range(channels):
+                frames[head + c] = int(frames[head + c] * level)
+                frames[tail + c] = int(frames[tail + c] * level)
+        return frames
+
+    @staticmethod
+    def period(period, amplitude, rate, waveform):
+        if waveform == 'sine':
+            return array('h', [int(amplitude * sin(2 * pi * t / period)) for t in range(period)])
+        if waveform == 'bandlimited':
+            # odd harmonics below the nyquist frequency only
+            harmonics = range(1, max(2, period // 2), 2)
+            wave = [sum(sin(2 * pi * k * t / period) / k for k in harmonics) for t in range(period)]
+            peak = max(abs(s) for s in wave) or 1
+            return array('h', [int(amplitude * s / peak) for s in wave])
+        half = period // 2
+        return array('h', [amplitude]) * half + array('h', [-amplitude]) * (period - half)
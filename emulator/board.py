@@ -0,0 +1,76 @@
+# runs one firmware main.py unmodified under CPython, its console is this process' stdin
+# and stdout (the master side of a pty), started by emulator.py
+import argparse
+import builtins
+import os
+import runpy
+import signal
+import sys
+import time
+
+# the uname().machine strings of the boards the firmware knows, on MicroPython input()
+# echoes, so only boards the controller expects to echo are emulated
+MACHINES = {
+    'Raspberry Pi Pico': 'Raspberry Pi Pico with RP2040',
+    'ESP D1 Mini': 'ESP module with ESP8266',
+}
+
+def write_all(data):
+    while data:
+        data = data[os.write(1, data):]
+
+def install(args):
+    # everything the firmware imports, before it is run
+    import hardware
+    from hardware import TICKS_PERIOD, Clock, Input, Output, Recorder
+    clock = hardware.clock = Clock(args.drift)
+    recorder = hardware.recorder = Recorder(args.record)
+    recorder.header(board=args.board, machine=MACHINES[args.board], firmware=args.firmware, drift=args.drift)
+    time.sleep_ms = lambda ms: time.sleep(clock.host_seconds(ms * 1000))
+    time.sleep_us = lambda us: time.sleep(clock.host_seconds(us))
+    time.ticks_us = lambda: int(clock.us()) % TICKS_PERIOD
+    time.ticks_ms = lambda: int(clock.us() / 1000) % TICKS_PERIOD
+    time.ticks_add = lambda ticks, delta: (ticks + delta) % TICKS_PERIOD
+    time.ticks_diff = lambda a, b: (a - b + TICKS_PERIOD // 2) % TICKS_PERIOD - TICKS_PERIOD // 2
+    os.uname = lambda: os.uname_result(('rp2' if 'RP2040' in MACHINES[args.board] else 'esp8266', 'emdr',
+                                        '1.22.0', 'emulated', MACHINES[args.board]))
+    sys.stdin = Input(lambda n: os.read(0, n))
+    sys.stdout = Output(write_all)
+
+    def input(prompt=''):
+        # the REPL echoes what was typed
+        line = sys.stdin.readline().rstrip('\r\n')
+        print(line)
+        return line
+    builtins.input = input
+
+    def terminate(signum, frame):
+        recorder.close()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    return recorder
+
+def main_board(argv):
+    parser = argparse.ArgumentParser(description='run a firmware on its console at stdin/stdout')
+    parser.add_argument('firmware', help='directory of the firmware main.py')
+    parser.add_argument('--board', default='Raspberry Pi Pico', choices=list(MACHINES.keys()))
+    parser.add_argument('--drift', type=float, default=0, help='clock error of the board in ppm')
+    parser.add_argument('--record', help='record frames and pin changes to this file')
+    args = parser.parse_args(argv)
+    # the firmware's own modules (neopixel) first, then the stubs of the MicroPython modules
+    sys.path[0:0] = [args.firmware, os.path.dirname(os.path.abspath(__file__))]
+    recorder = install(args)
+    try:
+        runpy.run_path(os.path.join(args.firmware, 'main.py'), run_name='__main__')
+    except EOFError:
+        # console closed
+        pass
+    except KeyboardInterrupt:
+        # on a real board main.py is dead now and the lightbar or buzzer stays dark
+        print('%s: main.py stopped by KeyboardInterrupt (ctrl-c on the console)' % args.firmware, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        recorder.close()
+
+if __name__ == '__main__':
+    main_board(sys.argv[1:])
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tty
+from time import sleep
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controller'))
+from board import MACHINES
+from timing import TickRecorder
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE = os.path.normpath(os.path.join(HERE, '..', 'firmware'))
+
+class EmulatedBoard():
+    # one firmware in its own process, its console on a pty which the controller opens like the
+    # serial port of a real board, Devices.probe finds it through EMDR_PORTS
+    def __init__(self, firmware, board, drift=0, record=None):
+        self.board = board
+        self.record = record
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # kept open, so the console does not hang up when the controller closes the port
+        self.slave = slave
+        cmd = [sys.executable, os.path.join(HERE, 'board.py'), os.path.join(FIRMWARE, firmware),
+               '--board', board, '--drift', str(drift)]
+        if record:
+            cmd += ['--record', record]
+        self.process = subprocess.Popen(cmd, stdin=master, stdout=master, start_new_session=True)
+        os.close(master)
+
+    def stop(self):
+        # returns the exit code of a board that stopped by itself, None if it was still running
+        stopped = self.process.poll()
+        self.process.terminate()
+        self.process.wait()
+        os.close(self.slave)
+        return stopped
+
+def start(lightbars=1, buzzers=1, board='Raspberry Pi Pico', drift=0, record=None):
+    # boards get drift, -drift, 2 * drift .. ppm, so they are not all off the same way
+    if record:
+        os.makedirs(record, exist_ok=True)
+    boards = []
+    for i, firmware in enumerate(['lightbar'] * lightbars + ['buzzer'] * buzzers):
+        name = '%s%d' % (firmware, i + 1 if firmware == 'lightbar' else i + 1 - lightbars)
+        boards.append(EmulatedBoard(firmware, board, drift * (i // 2 + 1) * (-1 if i % 2 else 1),
+                                    os.path.join(record, name + '.jsonl') if record else None))
+    return boards
+
+def ports(boards):
+    # the value of EMDR_PORTS
+    return ','.join('%s=%s' % (b.port, b.board) for b in boards)
+
+def read(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def stats(records):
+    # frames: count, intervals (ms), most pixels lit, pins: pulses with their durations and the
+    # intervals between their starts (ms), gaps of more than a second are left out
+    def summary(values):
+        values = sorted(v for v in values if v < 1000)
+        return {
+            'p50': TickRecorder.percentile(values, 50),
+            'p95': TickRecorder.percentile(values, 95),
+            'p99': TickRecorder.percentile(values, 99),
+            'max': values[-1] if values else 0,
+        }
+    frames = [r for r in records if 'frame' in r]
+    result = dict(records[0]) if records and 't' not in records[0] else {}
+    if frames:
+        result['frames'] = {
+            'count': len(frames),
+            'interval_ms': summary((b['t'] - a['t']) / 1000 for a, b in zip(frames, frames[1:])),
+            'max_lit': max(sum(1 for i in range(0, len(f['frame']), 6) if f['frame'][i:i + 6].strip('0'))
+                           for f in frames),
+        }
+    pins = {}
+    for r in records:
+        if 'pin' in r:
+            pins.setdefault(str(r['pin']), []).append((r['t'], r['value']))
+    for pin, changes in sorted(pins.items()):
+        starts = [t for t, v in changes if v]
+        durations = [(b[0] - a[0]) / 1000 for a, b in zip(changes, changes[1:]) if a[1] and not b[1]]
+        result.setdefault('pins', {})[pin] = {
+            'pulses': len(starts),
+            'duration_ms': summary(durations),
+            'interval_ms': summary((b - a) / 1000 for a, b in zip(starts, starts[1:])),
+        }
+    return result
+
+def main_emulator(argv):
+    parser = argparse.ArgumentParser(description='emulate lightbars and buzzers by running their firmware')
+    sub = parser.add_subparsers(dest='action', required=True)
+    p = sub.add_parser('run', help='start emulated boards, run a command with EMDR_PORTS set to them')
+    p.add_argument('--lightbars', type=int, default=1)
+    p.add_argument('--buzzers', type=int, default=1)
+    p.add_argument('--board', default='Raspberry Pi Pico', choices=list(MACHINES.keys()))
+    p.add_argument('--drift', type=float, default=0, help='clock error of the boards in ppm')
+    p.add_argument('--boot', type=float, default=1.5, help='seconds the firmware needs to start')
+    p.add_argument('--record', metavar='DIR', help='record frames and pulses of every board into DIR')
+    p.add_argument('command', nargs=argparse.REMAINDER,
+                   help='command to run, e.g. -- python3 controller/benchmark.py --probe, '
+                        'without one the boards run until interrupted')
+    p = sub.add_parser('stats', help='frame and pulse timing of recorded boards')
+    p.add_argument('files', nargs='+')
+    args = parser.parse_args(argv)
+    if args.action == 'stats':
+        json.dump({f: stats(read(f)) for f in args.files}, sys.stdout, indent=2)
+        print()
+        return
+    boards = start(args.lightbars, args.buzzers, args.board, args.drift, args.record)
+    status = 0
+    try:
+        # the firmware shows its test pattern before it reads commands
+        sleep(args.boot)
+        command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        if command:
+            status = subprocess.call(command, env=dict(os.environ, EMDR_PORTS=ports(boards)))
+        else:
+            print('EMDR_PORTS=%s' % ports(boards), flush=True)
+            while all(b.process.poll() is None for b in boards):
+                sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for b in boards:
+            if b.stop() is not None:
+                print('board on %s stopped during the run' % b.port, file=sys.stderr)
+                status = status or 1
+    if args.record:
+        json.dump({b.record: stats(read(b.record)) for b in boards}, sys.stderr, indent=2)
+        print(file=sys.stderr)
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main_emulator(sys.argv[1:])
@@ -0,0 +1,112 @@
+import json
+from threading import RLock, local
+from time import perf_counter
+
+# MicroPython ticks wrap at 2**30 on the rp2, esp8266 and mimxrt ports
+TICKS_PERIOD = 1 << 30
+
+class Clock():
+    # the board's microsecond clock, starting at 0 at boot, running fast or slow by drift ppm
+    # like a real crystal, so the host's clock sync has something to do
+    def __init__(self, drift=0):
+        self.rate = 1 + drift / 1e6
+        self.boot = perf_counter()
+
+    def us(self):
+        return (perf_counter() - self.boot) * self.rate * 1e6
+
+    def host_seconds(self, us):
+        # board microseconds as host seconds
+        return us / self.rate / 1e6
+
+clock = Clock()
+
+# held while interrupts are disabled and while a timer callback runs, callbacks of the soft
+# timers never run at the same time as a section between disable_irq() and enable_irq()
+irq = RLock()
+
+class Recorder():
+    # JSON lines of what the board did, times in board microseconds since boot:
+    # {"t": .., "frame": "<hex of the strip buffer>"} for every bitstream written,
+    # {"t": .., "pin": .., "value": 0|1} for every change of an output pin
+    def __init__(self, filename=None):
+        self.file = open(filename, 'w') if filename else None
+
+    def header(self, **info):
+        self.write(info)
+
+    def frame(self, t, buf):
+        self.write({'t': int(t), 'frame': bytes(buf).hex()})
+
+    def pin(self, t, pin, value):
+        self.write({'t': int(t), 'pin': pin, 'value': value})
+
+    def write(self, record):
+        if self.file:
+            self.file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+recorder = Recorder()
+
+class Output():
+    # sys.stdout of the board: print() of the firmware is atomic like on MicroPython, where soft
+    # timer callbacks only run between bytecodes, lines end with CR LF like on the USB console
+    def __init__(self, write):
+        self.raw_write = write
+        self.lock = RLock()
+        self.pending = local()
+
+    def write(self, s):
+        text = getattr(self.pending, 'text', '') + s
+        if '\n' not in text:
+            self.pending.text = text
+            return len(s)
+        text, self.pending.text = text.rpartition('\n')[::2]
+        with self.lock:
+            self.raw_write((text + '\n').replace('\n', '\r\n').encode())
+        return len(s)
+
+    def flush(self):
+        pass
+
+class Input():
+    # sys.stdin of the board, text lines and binary frames read from the same buffer,
+    # buffer.readinto() blocks until the whole frame is there like on MicroPython
+    # ctrl-c raises KeyboardInterrupt and stops main.py like on MicroPython, unless
+    # micropython.kbd_intr(-1) was called
+    interrupt_char = 3
+
+    def __init__(self, read):
+        self.raw_read = read
+        self.data = bytearray()
+        self.buffer = self
+
+    def fill(self):
+        chunk = self.raw_read(4096)
+        if not chunk:
+            raise EOFError()
+        if self.interrupt_char >= 0 and self.interrupt_char in chunk:
+            # the console drops the character
+            self.data += chunk.replace(bytes([self.interrupt_char]), b'')
+            raise KeyboardInterrupt()
+        self.data += chunk
+
+    def readinto(self, mv):
+        while len(self.data) < len(mv):
+            self.fill()
+        n = len(mv)
+        mv[:] = self.data[:n]
+        del self.data[:n]
+        return n
+
+    def readline(self):
+        while b'\n' not in self.data:
+            self.fill()
+        n = self.data.index(b'\n') + 1
+        line = bytes(self.data[:n])
+        del self.data[:n]
+        return line.decode(errors='replace')
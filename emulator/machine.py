@@ -0,0 +1,128 @@
+# the part of MicroPython's machine module the firmware uses, imported by the firmware
+# as 'machine' when it runs in the emulator
+import heapq
+from threading import Condition
+from _thread import start_new_thread
+from time import perf_counter, sleep
+from traceback import print_exc
+from hardware import clock, irq, recorder
+
+class Pin():
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=-1, value=None):
+        self.id = id
+        self.state = 0
+        self.init(mode, value)
+
+    def init(self, mode=-1, value=None):
+        if mode != -1:
+            self.mode = mode
+        if value is not None:
+            self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self.state
+        value = 1 if value else 0
+        if value != self.state:
+            self.state = value
+            recorder.pin(clock.us(), self.id, value)
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def high(self):
+        self.value(1)
+
+    def low(self):
+        self.value(0)
+
+def bitstream(pin, encoding, timing, buf):
+    # interrupts are off while the bits are clocked out, a WS2812 strip latches the frame after it
+    high_0, low_0, high_1, low_1 = timing
+    ones = int.from_bytes(buf, 'big').bit_count()
+    ns = ones * (high_1 + low_1) + (len(buf) * 8 - ones) * (high_0 + low_0)
+    with irq:
+        end = perf_counter() + clock.host_seconds(ns / 1000)
+        while perf_counter() < end:
+            pass
+        recorder.frame(clock.us(), buf)
+
+def disable_irq():
+    irq.acquire()
+    return 1
+
+def enable_irq(state):
+    irq.release()
+
+class Timer():
+    # soft timers, all served by one thread in due order, the callbacks run with interrupts
+    # disabled for the firmware's main code
+    ONE_SHOT = 0
+    PERIODIC = 1
+    cond = Condition()
+    # (due, sequence, timer, generation)
+    queue = []
+    sequence = 0
+    started = False
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        # a deinit or init makes queued entries of earlier generations stale
+        self.generation = 0
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, freq=-1):
+        if freq > 0:
+            period = 1000 / freq
+        cls = Timer
+        with cls.cond:
+            self.generation += 1
+            self.mode = mode
+            self.interval = clock.host_seconds(max(period, 1) * 1000)
+            self.callback = callback
+            self.push(perf_counter() + self.interval)
+            if not cls.started:
+                cls.started = True
+                start_new_thread(cls.loop, (()))
+            cls.cond.notify()
+
+    def deinit(self):
+        with Timer.cond:
+            self.generation += 1
+
+    def push(self, due):
+        Timer.sequence += 1
+        heapq.heappush(Timer.queue, (due, Timer.sequence, self, self.generation))
+
+    @classmethod
+    def loop(cls):
+        while True:
+            with cls.cond:
+                while not cls.queue or cls.queue[0][0] > perf_counter():
+                    cls.cond.wait(cls.queue[0][0] - perf_counter() if cls.queue else None)
+                due, _, timer, generation = heapq.heappop(cls.queue)
+                if generation != timer.generation:
+                    continue
+                if timer.mode == cls.PERIODIC:
+                    # keeps the period, unless it fell behind by a whole period
+                    timer.push(max(due + timer.interval, perf_counter()))
+                callback = timer.callback
+            with irq:
+                try:
+                    if callback:
+                        callback(timer)
+                except Exception:
+                    # like MicroPython: report and disable the timer
+                    print_exc()
+                    timer.deinit()
+            sleep(0)
@@ -0,0 +1,6 @@
+# the part of MicroPython's micropython module the firmware uses
+from hardware import Input
+
+def kbd_intr(chr):
+    # the character raising KeyboardInterrupt while a script runs, -1 for none
+    Input.interrupt_char = chr
@@ -1,8 +1,28 @@
 from os import uname
-from machine import Pin
-from time import sleep_ms
+from sys import stdin
+from machine import Pin, Timer, disable_irq, enable_irq
+from micropython import kbd_intr
+from time import sleep_ms, ticks_us, ticks_add, ticks_diff
 
 ID = 'EMDR Buzzer'
+# capabilities announced after the id, 'bin' = binary frames, 'noecho' = echo can be switched off,
+# 'sync' = clock sync and scheduled commands
+CAPS = 'bin noecho sync'
+# scheduled commands waiting for their time
+MAX_PENDING = 8
+
+# binary frame: opcode (command letter | 0x80), sequence, 24 bit payload (big endian)
+FRAME_LEN = 5
+frame = bytearray(FRAME_LEN)
+frame_mv = memoryview(frame)
+
+CMD_LEFT = ord('l')
+CMD_RIGHT = ord('r')
+CMD_ID = ord('i')
+CMD_BINARY = ord('b')
+CMD_ECHO = ord('e')
+CMD_SYNC = ord('T')
+CMD_AT = ord('@')
 
 machine = uname().machine
 pin_no = 0
@@ -10,46 +30,174 @@ if machine.startswith('Teensy 4.0'):
     pin_no_left = 'D23'
     pin_no_right = 'D22'
 elif machine.startswith('ESP module'):
-    pin_no_left = 12  
+    pin_no_left = 12
     pin_no_right = 14
 elif machine.startswith('Raspberry Pi Pico'):
     pin_no_left = 19
     pin_no_right = 18
-    
-pin_left = Pin(pin_no_left, Pin.OUT)
-pin_right = Pin(pin_no_right, Pin.OUT)
-
-def buzz(pin, duration_ms):
-    pin.on()
-    sleep_ms(duration_ms)
-    pin.off()
-    
+
+class Channel():
+    # switches the motor off from a one-shot timer, so commands are read while a pulse is active,
+    # and both channels can overlap
+    def __init__(self, pin_no, name):
+        self.pin = Pin(pin_no, Pin.OUT)
+        self.name = name
+        self.active = False
+        self.timer = Timer(-1)
+        # bound once, so arming the timer does not allocate
+        self.off_cb = self.off
+
+    def pulse(self, duration_ms):
+        if self.active:
+            # report the overlap, the new pulse replaces the running one
+            print('busy ' + self.name)
+        self.active = True
+        self.pin.on()
+        self.timer.init(mode=Timer.ONE_SHOT, period=max(duration_ms, 1), callback=self.off_cb)
+
+    def off(self, timer):
+        self.pin.off()
+        self.active = False
+
+left = Channel(pin_no_left, 'l')
+right = Channel(pin_no_right, 'r')
+
+def at_ticks(val):
+    # the ticks_us time nearest to now with the low 24 bits val
+    now = ticks_us()
+    d = (val - now) & 0xffffff
+    if d >= 0x800000:
+        d -= 0x1000000
+    return ticks_add(now, d)
+
+class Pending():
+    # commands to be executed at a given time, sorted by time, a 1 ms timer polls the earliest
+    # one and waits out the last fraction of a millisecond, late ones are executed at once
+    def __init__(self):
+        self.queue = []
+        self.timer = Timer(-1)
+        self.running = False
+        self.poll_cb = self.poll
+
+    def add(self, at, cmd, val):
+        if len(self.queue) >= MAX_PENDING:
+            raise OverflowError()
+        state = disable_irq()
+        i = len(self.queue)
+        while i and ticks_diff(self.queue[i - 1][0], at) > 0:
+            i -= 1
+        self.queue.insert(i, (at, cmd, val))
+        enable_irq(state)
+        if not self.running:
+            self.running = True
+            self.timer.init(period=1, mode=Timer.PERIODIC, callback=self.poll_cb)
+
+    def poll(self, timer):
+        while self.queue:
+            at = self.queue[0][0]
+            if ticks_diff(at, ticks_us()) > 1000:
+                return
+            while ticks_diff(at, ticks_us()) > 0:
+                pass
+            _, cmd, val = self.queue.pop(0)
+            try:
+                execute(cmd, val)
+            except:
+                print('error')
+        self.timer.deinit()
+        self.running = False
+
+pending = Pending()
+
 def test():
-    buzz(pin_left, 50)
+    left.pulse(50)
     sleep_ms(1000)
-    buzz(pin_right, 50)
-    
+    right.pulse(50)
+
+echo = True
+
+def readline():
+    # input() echoes like the REPL does, the host can switch that off
+    return input() if echo else stdin.readline().strip()
+
+def parse(line):
+    cmd, val, *_ = (line + ' ').split(' ')
+    try:
+        val = int(val)
+    except:
+        val = 0
+    return ord(cmd[0]) if cmd else 0, val
+
+def execute(cmd, val):
+    # pulses, at once or from the pending queue
+    if cmd == CMD_LEFT:
+        # buzz left
+        left.pulse(val)
+    elif cmd == CMD_RIGHT:
+        # buzz right
+        right.pulse(val)
+
 def loop():
-    global np
+    global echo
+    binary = False
+    seq = 0
+    # time of the next command, set by '@'
+    at = None
     while True:
-        line = input()
-        cmd, val, *_ = (line + ' ').split(' ')
-        try:
-            val = int(val)
-        except:
-            val = 0
+        if binary:
+            stdin.buffer.readinto(frame_mv[0:1])
+            if frame[0] & 0x80:
+                stdin.buffer.readinto(frame_mv[1:])
+                cmd = frame[0] & 0x7f
+                seq = frame[1]
+                val = (frame[2] << 16) | (frame[3] << 8) | frame[4]
+            else:
+                # a plain character, host fell back to the text protocol
+                binary = False
+                kbd_intr(3)
+                cmd, val = parse(chr(frame[0]) + readline())
+        else:
+            line = readline()
+            if line.startswith('@'):
+                # @<time> <command>: execute the command at that time
+                time, _, line = line[1:].partition(' ')
+                try:
+                    at = at_ticks(int(time))
+                except:
+                    at = None
+            cmd, val = parse(line)
         try:
-            if cmd == 'l':
-                # buzz left
-                buzz(pin_left, val)
-            elif cmd == 'r':
-                # buzz right
-                buzz(pin_right, val)
-            elif cmd == 'i':
+            if cmd == CMD_AT:
+                # the next binary frame is executed at time val
+                at = at_ticks(val)
+                continue
+            if cmd == CMD_ID:
                 # id command
-                print(ID)
+                print(ID + ' ' + CAPS)
+            elif cmd == CMD_BINARY:
+                # switch between text and binary protocol, frames are full of 0x03 bytes,
+                # which must not raise a KeyboardInterrupt (ctrl-c) while binary, and the
+                # host sends them only after the 'ok'
+                binary = val != 0
+                kbd_intr(-1 if binary else 3)
+                print('ok')
+            elif cmd == CMD_ECHO:
+                # switch the echo of text commands on or off
+                echo = val != 0
+                print('ok')
+            elif cmd == CMD_SYNC:
+                # clock sync: answer with the low 24 bits of our microsecond ticks
+                print('T %d %d' % (val, ticks_us() & 0xffffff))
+            elif at is not None:
+                pending.add(at, cmd, val)
+            else:
+                execute(cmd, val)
         except:
-            print('error')
+            if binary:
+                print('error %d' % seq)
+            else:
+                print('error')
+        at = None
 
 test()
 loop()
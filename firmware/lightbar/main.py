@@ -1,10 +1,38 @@
 from os import uname
-from machine import Pin
+from sys import stdin
+from machine import Pin, Timer, disable_irq, enable_irq
+from micropython import kbd_intr
 from neopixel import NeoPixel
-from time import sleep_ms
+from time import sleep_ms, ticks_us, ticks_add, ticks_diff
+from math import log
 
 NUMLED = 57
+MIDDLE = NUMLED // 2 + 1
 ID = 'EMDR Lightbar'
+# capabilities announced after the id, 'bin' = binary frames, 'noecho' = echo can be switched off,
+# 'auto' = autonomous sweep, 'tail' = fading tail, 'sync' = clock sync and scheduled commands
+CAPS = 'bin noecho auto tail sync'
+MAX_TAIL = 16
+# scheduled commands waiting for their time
+MAX_PENDING = 8
+
+# binary frame: opcode (command letter | 0x80), sequence, 24 bit payload (big endian)
+FRAME_LEN = 5
+frame = bytearray(FRAME_LEN)
+frame_mv = memoryview(frame)
+
+CMD_COLOR = ord('c')
+CMD_LED = ord('l')
+CMD_TEST = ord('t')
+CMD_ID = ord('i')
+CMD_BINARY = ord('b')
+CMD_ECHO = ord('e')
+CMD_SWEEP = ord('s')
+CMD_SPEED = ord('v')
+CMD_HALT = ord('h')
+CMD_TAIL = ord('f')
+CMD_SYNC = ord('T')
+CMD_AT = ord('@')
 
 machine = uname().machine
 pin_no = 0
@@ -16,10 +44,191 @@ elif machine.startswith('Raspberry Pi Pico'):
     pin_no = 16
 
 np = NeoPixel(Pin(pin_no), NUMLED, bpp=3)
+col = (0x0f, 0, 0)
+zero = bytearray(len(np.buf))
 
 def clear():
-    np.fill([0] * len(np))
-    
+    np.buf[:] = zero
+
+class Renderer():
+    # uses the strip buffer as frame buffer and only rewrites the pixels that change,
+    # the led and its fading tail are copied from a lookup table in strip byte order,
+    # which is rebuilt on colour or tail length changes only
+    def __init__(self):
+        self.lut = bytearray(3 * (MAX_TAIL + 1))
+        self.tail = 0
+        # range of lit pixels, empty if lo > hi
+        self.lo = 0
+        self.hi = -1
+        self.pos = 0
+        self.direction = 1
+        self.build()
+
+    def build(self):
+        for k in range(self.tail + 1):
+            level = ((self.tail + 1 - k) / (self.tail + 1)) ** 2
+            for i in range(3):
+                self.lut[3 * k + np.ORDER[i]] = int(col[i] * level)
+
+    def set_tail(self, tail):
+        self.tail = max(0, min(tail, MAX_TAIL))
+        self.build()
+
+    def invalidate(self):
+        # the whole strip may have been drawn on
+        self.lo = 0
+        self.hi = NUMLED - 1
+
+    def draw(self, pos):
+        # pos 1..NUMLED lights a led, anything else switches all off
+        if self.pos and pos != self.pos:
+            self.direction = 1 if pos > self.pos else -1
+        self.pos = pos
+        head = pos - 1
+        lo = 0
+        hi = -1
+        if 1 <= pos <= NUMLED:
+            end = head - self.direction * self.tail
+            lo = max(0, min(head, end))
+            hi = min(NUMLED - 1, max(head, end))
+        b = np.buf
+        lut = self.lut
+        for p in range(self.lo, self.hi + 1):
+            if p < lo or p > hi:
+                o = 3 * p
+                b[o] = 0
+                b[o + 1] = 0
+                b[o + 2] = 0
+        for p in range(lo, hi + 1):
+            # distance behind the head
+            k = 3 * (head - p) * self.direction
+            o = 3 * p
+            b[o] = lut[k]
+            b[o + 1] = lut[k + 1]
+            b[o + 2] = lut[k + 2]
+        self.lo = lo
+        self.hi = hi
+        np.write()
+
+renderer = Renderer()
+
+class Sweep():
+    # autonomous sweep, mirrors Controller.action of the controller app,
+    # reports 'L'/'R' at the ends, 'M <counter>' in the middle and 'E' when finished
+    def __init__(self):
+        self.timer = Timer(-1)
+        self.running = False
+        n = NUMLED - MIDDLE
+        self.alpha = log(1.2) / (log(n) - log(n - 1))
+        self.factor = 1.5 / n ** self.alpha
+
+    def start(self, speed, count, decay):
+        self.set_speed(speed)
+        self.count = count
+        self.decay = decay
+        self.halting = False
+        self.decaying = False
+        if not self.running:
+            self.pos = MIDDLE
+            self.direction = -1
+            self.counter = 0
+            self.extra_us = 0
+            self.next = ticks_us()
+            self.running = True
+            # polling our own deadlines every ms is more precise than ms timer periods
+            self.timer.init(period=1, mode=Timer.PERIODIC, callback=self.tick)
+
+    def set_speed(self, speed):
+        self.period_us = 60000000 // max(speed, 1) // NUMLED // 2
+        self.extra_us = 0
+
+    def halt(self):
+        self.halting = True
+
+    def stop(self):
+        if self.running:
+            self.timer.deinit()
+            self.running = False
+
+    def tick(self, timer):
+        while self.running and ticks_diff(ticks_us(), self.next) >= 0:
+            self.step()
+            self.next = ticks_add(self.next, self.period_us + self.extra_us)
+
+    def step(self):
+        renderer.draw(self.pos)
+        if self.pos == 1:
+            # left end
+            print('L')
+            self.direction = 1
+        if self.pos == NUMLED:
+            # right end
+            print('R')
+            self.direction = -1
+            if self.counter == self.count or self.halting:
+                self.decaying = True
+        if self.pos == MIDDLE and self.direction == -1:
+            # in the middle
+            if self.decaying:
+                self.stop()
+                print('E')
+                return
+            self.counter += 1
+            print('M %d' % self.counter)
+        self.pos += self.direction
+        if self.decaying and self.decay:
+            pos = NUMLED - self.pos
+            self.extra_us = self.period_us + int((self.factor * pos ** self.alpha) * 1000000)
+
+sweep = Sweep()
+
+def at_ticks(val):
+    # the ticks_us time nearest to now with the low 24 bits val
+    now = ticks_us()
+    d = (val - now) & 0xffffff
+    if d >= 0x800000:
+        d -= 0x1000000
+    return ticks_add(now, d)
+
+class Pending():
+    # commands to be executed at a given time, sorted by time, a 1 ms timer polls the earliest
+    # one and waits out the last fraction of a millisecond, late ones are executed at once
+    def __init__(self):
+        self.queue = []
+        self.timer = Timer(-1)
+        self.running = False
+        self.poll_cb = self.poll
+
+    def add(self, at, cmd, val):
+        if len(self.queue) >= MAX_PENDING:
+            raise OverflowError()
+        state = disable_irq()
+        i = len(self.queue)
+        while i and ticks_diff(self.queue[i - 1][0], at) > 0:
+            i -= 1
+        self.queue.insert(i, (at, cmd, val))
+        enable_irq(state)
+        if not self.running:
+            self.running = True
+            self.timer.init(period=1, mode=Timer.PERIODIC, callback=self.poll_cb)
+
+    def poll(self, timer):
+        while self.queue:
+            at = self.queue[0][0]
+            if ticks_diff(at, ticks_us()) > 1000:
+                return
+            while ticks_diff(at, ticks_us()) > 0:
+                pass
+            _, cmd, val = self.queue.pop(0)
+            try:
+                execute(cmd, val)
+            except:
+                print('error')
+        self.timer.deinit()
+        self.running = False
+
+pending = Pending()
+
 def test():
     global np
     clear()
@@ -30,39 +239,114 @@ def test():
     clear()
     np.write()
 
+echo = True
+
+def readline():
+    # input() echoes like the REPL does, the host can switch that off
+    return input() if echo else stdin.readline().strip()
+
+def parse(line):
+    cmd, val, *_ = (line + ' ').split(' ')
+    try:
+        val = int(val)
+    except:
+        val = 0
+    return ord(cmd[0]) if cmd else 0, val
+
+def execute(cmd, val):
+    # commands acting on the strip, at once or from the pending queue
+    global col
+    if cmd == CMD_COLOR:
+        # color cmd
+        col = ((val >> 16) & 0xff, (val >> 8) & 0xff, val & 0xff)
+        renderer.build()
+    elif cmd == CMD_LED:
+        # led cmd
+        sweep.stop()
+        renderer.draw(val)
+    elif cmd == CMD_TEST:
+        # test command
+        sweep.stop()
+        clear()
+        np[0] = col
+        np[-1] = col
+        np.write()
+        renderer.invalidate()
+    elif cmd == CMD_SWEEP:
+        # autonomous sweep: speed | count << 8 | decay << 16, resumes a halting sweep
+        sweep.start(val & 0xff, (val >> 8) & 0xff, (val >> 16) & 1)
+    elif cmd == CMD_SPEED:
+        # speed of the autonomous sweep
+        sweep.set_speed(val)
+    elif cmd == CMD_HALT:
+        # finish the autonomous sweep in the middle
+        sweep.halt()
+    elif cmd == CMD_TAIL:
+        # length of the fading tail behind the led
+        renderer.set_tail(val)
 
 def loop():
-    global np
-    col = (0x0f, 0, 0)
+    global echo
+    binary = False
+    seq = 0
+    # time of the next command, set by '@'
+    at = None
     while True:
-        line = input()
-        cmd, val, *_ = (line + ' ').split(' ')
+        if binary:
+            stdin.buffer.readinto(frame_mv[0:1])
+            if frame[0] & 0x80:
+                stdin.buffer.readinto(frame_mv[1:])
+                cmd = frame[0] & 0x7f
+                seq = frame[1]
+                val = (frame[2] << 16) | (frame[3] << 8) | frame[4]
+            else:
+                # a plain character, host fell back to the text protocol
+                binary = False
+                kbd_intr(3)
+                cmd, val = parse(chr(frame[0]) + readline())
+        else:
+            line = readline()
+            if line.startswith('@'):
+                # @<time> <command>: execute the command at that time
+                time, _, line = line[1:].partition(' ')
+                try:
+                    at = at_ticks(int(time))
+                except:
+                    at = None
+            cmd, val = parse(line)
         try:
-            val = int(val)
-        except:
-            val = 0
-        try:
-            if cmd == 'c':
-                # color cmd
-                col = ((val >> 16) & 0xff, (val >> 8) & 0xff, val & 0xff)
-            elif cmd == 'l':
-                # led cmd
-                clear()
-                np[val - 1] = col
-                np.write()
-            elif cmd == 't':
-                # test command
-                clear()
-                np[0] = col
-                np[-1] = col
-                np.write()
-            elif cmd == 'i':
+            if cmd == CMD_AT:
+                # the next binary frame is executed at time val
+                at = at_ticks(val)
+                continue
+            if cmd == CMD_ID:
                 # id command
-                print(ID)
+                print(ID + ' ' + CAPS)
+            elif cmd == CMD_BINARY:
+                # switch between text and binary protocol, frames are full of 0x03 bytes,
+                # which must not raise a KeyboardInterrupt (ctrl-c) while binary, and the
+                # host sends them only after the 'ok'
+                binary = val != 0
+                kbd_intr(-1 if binary else 3)
+                print('ok')
+            elif cmd == CMD_ECHO:
+                # switch the echo of text commands on or off
+                echo = val != 0
+                print('ok')
+            elif cmd == CMD_SYNC:
+                # clock sync: answer with the low 24 bits of our microsecond ticks
+                print('T %d %d' % (val, ticks_us() & 0xffffff))
+            elif at is not None:
+                pending.add(at, cmd, val)
+            else:
+                execute(cmd, val)
         except:
-            print('error')
+            if binary:
+                print('error %d' % seq)
+            else:
+                print('error')
+        at = None
 
 test()
 loop()
-            
-            
\ No newline at end of file
+